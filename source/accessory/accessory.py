@@ -1,5 +1,7 @@
+import argparse
 import logging
 import os.path
+import sys
 
 import dbus
 import dbus.exceptions
@@ -7,6 +9,7 @@ import dbus.mainloop.glib
 import dbus.service
 from gi.repository import GObject
 
+import adv_schedule
 import beacon
 import gatt_server
 import logger_config
@@ -14,37 +17,134 @@ import logger_config
 global AccessoryKeyPath
 AccessoryKeyPath = 'AccessoryKey'
 
+logger = logging.getLogger('BLELogger')
 
-def run():
-    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-    mainloop = GObject.MainLoop()
-    bus = dbus.SystemBus()
-    logger.info('Create GattServer Application')
-    application = gatt_server.GattServerCtrl(mainloop, bus)
-    application.start()
-    timeout_id = 0
-    # when finish writing, write cmd to trigger mainloop.quit()
-    if not os.path.isfile(AccessoryKeyPath):
-        adv = beacon.ConfigCtrl(mainloop, bus)
-    else:
-        with open(AccessoryKeyPath, 'rb') as f:
-            key = f.read()
-            f.close()
-        adv = beacon.BeaconCtrl(mainloop, bus, key)
-        timeout_id = GObject.timeout_add(5 * 60 * 1000, application.stop)
-        logger.debug('timeout ID:{}'.format(timeout_id))
-    adv.start()
-    mainloop.run()
-    if timeout_id:
-        GObject.source_remove(timeout_id)
+# CONFIG: no key yet, config advert + GATT server waiting for one.
+# PROVISION: beacon adverts, GATT server still open so the owner can
+#   rewrite the key; lasts `window` seconds after start or a new key.
+# BEACON: beacon adverts only.
+CONFIG = 'config'
+PROVISION = 'provision'
+BEACON = 'beacon'
+
+
+def load_key(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        key = f.read()
+        f.close()
+    return key
+
+
+class AccessoryDaemon():
+    # Registers the D-Bus objects once and moves between states by
+    # starting/stopping them, instead of rebuilding everything per cycle.
+    # The key is read from disk once and then kept in memory.
+    def __init__(self, mainloop, bus, window=5 * 60,
+                 schedule=adv_schedule.SCHEDULES['normal'], key_format='split'):
+        self.mainloop = mainloop
+        self.bus = bus
+        self.window = window
+        self.schedule = schedule
+        self.key_format = key_format
+        self.key = load_key(AccessoryKeyPath)
+        self.state = None
+        self.window_id = 0
+        self.stopped = False
+        logger.info('Create GattServer Application')
+        self.gatt = gatt_server.GattServerCtrl(mainloop, bus, self.on_key)
+        self.config = beacon.ConfigCtrl(mainloop, bus)
+        self.beacon = None
+
+    def on_key(self, key):
+        # a new key came in over GATT (already saved to AccessoryKeyPath)
+        self.key = key
+        if self.beacon is not None:
+            if self.beacon.registered:
+                self.beacon.stop()
+            self.beacon.update_key(key)
+        self.enter(PROVISION)
+
+    def on_window_end(self):
+        self.window_id = 0
+        self.enter(BEACON)
+        return False
+
+    def enter(self, state):
+        logger.info('state: %s -> %s', self.state, state)
+        self.state = state
+        if self.window_id:
+            GObject.source_remove(self.window_id)
+            self.window_id = 0
+        if state == CONFIG:
+            if self.beacon is not None and self.beacon.registered:
+                self.beacon.stop()
+            if not self.gatt.registered:
+                self.gatt.start()
+            if not self.config.registered:
+                self.config.start()
+            return
+        if self.config.registered:
+            self.config.stop()
+        if self.beacon is None:
+            self.beacon = beacon.BeaconCtrl(self.mainloop, self.bus, self.key,
+                                            self.schedule, self.key_format)
+        if not self.beacon.registered:
+            self.beacon.start()
+        if state == PROVISION:
+            if not self.gatt.registered:
+                self.gatt.start()
+            # seconds granularity lets GLib batch this wakeup with others
+            self.window_id = GObject.timeout_add_seconds(self.window,
+                                                         self.on_window_end)
+        elif self.gatt.registered:
+            self.gatt.stop()
+
+    def run(self):
+        self.enter(PROVISION if self.key else CONFIG)
+        # only returns on stop() or when BlueZ rejects a registration
+        self.mainloop.run()
+        return self.stopped
+
+    def stop(self):
+        self.stopped = True
+        if self.window_id:
+            GObject.source_remove(self.window_id)
+            self.window_id = 0
+        for ctrl in (self.beacon, self.config, self.gatt):
+            if ctrl is not None and ctrl.registered:
+                ctrl.stop()
+        self.mainloop.quit()
 
 
 if __name__ == '__main__':
-    logger_config.init_logger()
-    global logger
-    logger = logging.getLogger('BLELogger')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log-level', type=str, default='DEBUG',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-file', type=str, default=None,
+                        help='log through a queue to this rotating file')
+    parser.add_argument('--window', type=int, default=5 * 60,
+                        help='seconds the GATT server stays open for re-keying')
+    parser.add_argument('--schedule', type=str, default='normal',
+                        choices=sorted(adv_schedule.SCHEDULES),
+                        help='beacon advertising schedule')
+    parser.add_argument('--key-format', type=str, default='split',
+                        choices=beacon.KEY_FORMATS,
+                        help="'compact' needs the key in the server directory "
+                             "(device.py --role owner-set --server on)")
+    args = parser.parse_args()
+    logger_config.init_logger(args.log_level, args.log_file)
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    mainloop = GObject.MainLoop()
+    bus = dbus.SystemBus()
+    daemon = AccessoryDaemon(mainloop, bus, args.window,
+                             adv_schedule.SCHEDULES[args.schedule],
+                             args.key_format)
     try:
-        while True:
-            run()
+        if not daemon.run():
+            # registration failed; let the service manager restart us
+            logger.error('BlueZ registration failed, exiting')
+            sys.exit(1)
     except KeyboardInterrupt:
-        pass
+        daemon.stop()
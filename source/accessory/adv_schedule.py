@@ -0,0 +1,64 @@
+import collections
+
+# slot: seconds each key fragment stays on air before BlueZ rotates to the
+#   next one (the advertisement Duration).
+# interval_ms: BLE advertising interval while on air; None keeps the BlueZ
+#   default.
+# burst / period: advertise for `burst` seconds out of every `period`;
+#   burst == period advertises continuously.
+Schedule = collections.namedtuple('Schedule',
+                                  ['slot', 'interval_ms', 'burst', 'period'])
+
+SCHEDULES = {
+    # the owner is looking for the tag: continuous, fast advertising
+    'lost-fast': Schedule(slot=1, interval_ms=100, burst=60, period=60),
+    # the old behaviour: continuous, 3 s per fragment, default interval
+    'normal': Schedule(slot=3, interval_ms=None, burst=60, period=60),
+    # sitting at home: a 12 s burst every 2 minutes at a slow interval
+    'idle-slow': Schedule(slot=3, interval_ms=1000, burst=12, period=120),
+}
+
+# BlueZ default advertising interval (1.28 s) when interval_ms is None
+DEFAULT_INTERVAL_MS = 1280
+# radio time of one legacy advertising event: a ~0.4 ms PDU on each of the
+# 3 primary channels plus TX ramp-up
+ADV_EVENT_MS = 1.6
+FRAGMENTS = 3
+
+
+def validate(schedule, adverts=FRAGMENTS):
+    if schedule.slot <= 0 or schedule.burst <= 0:
+        raise ValueError('slot and burst must be positive: {}'.format(schedule))
+    if schedule.burst > schedule.period:
+        raise ValueError('burst longer than period: {}'.format(schedule))
+    # each burst restarts the rotation, so it must fit every advert
+    if schedule.burst < adverts * schedule.slot:
+        raise ValueError('burst {}s cannot carry {} adverts of {}s'.format(
+            schedule.burst, adverts, schedule.slot))
+    return schedule
+
+
+def continuous(schedule):
+    return schedule.burst >= schedule.period
+
+
+def estimate(schedule, adverts=FRAGMENTS):
+    # rough per-hour cost and the worst case wait for a scanner in range
+    # to collect the full key (to see every advert in the rotation)
+    on_fraction = schedule.burst / schedule.period
+    interval_ms = schedule.interval_ms or DEFAULT_INTERVAL_MS
+    events = on_fraction * 3600 * 1000 / interval_ms
+    # bluetoothd rotates adverts every slot; we start/stop each burst
+    wakeups = on_fraction * 3600 / schedule.slot if adverts > 1 else 0
+    if not continuous(schedule):
+        wakeups += 2 * 3600 / schedule.period
+    full_key = adverts * schedule.slot + interval_ms / 1000
+    if not continuous(schedule):
+        full_key += schedule.period - schedule.burst
+    return {
+        'duty_cycle': round(on_fraction, 3),
+        'adv_events_per_hour': int(events),
+        'radio_on_s_per_hour': round(events * ADV_EVENT_MS / 1000, 2),
+        'host_wakeups_per_hour': int(wakeups),
+        'max_time_to_key_s': round(full_key, 1),
+    }
@@ -5,7 +5,9 @@ import dbus
 import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
+from gi.repository import GObject
 
+import adv_schedule
 from ble_helper import (
     BLUEZ_SERVICE_NAME,
     DBUS_PROP_IFACE,
@@ -13,14 +15,41 @@ from ble_helper import (
     LE_ADVERTISEMENT_IFACE,
     InvalidArgsException,
     ID_MANUFACTURE,
+    INDEX_COMPACT,
+    INDEX_FULL,
     UUID_BEACONSERVICE_SHORT,
     UUID_CONFIGSERVICE_SHORT,
     find_adapter_path,
+    key_id,
 )
 
 logger = logging.getLogger('BLELogger')
 
 
+KEY_FORMATS = ('split', 'compact', 'both', 'extended')
+
+
+def key_fragments(key):
+    # the 64-byte key as the three beacon payloads, indexed 1..3
+    return [key[0:22], key[22:44],
+            key[44:64] + 0xFFFF.to_bytes(2, byteorder='little')]
+
+
+def beacon_payloads(key, key_format='split'):
+    # [(index, data)]: 'split' is the 3-fragment key every scanner reads,
+    # 'compact' one advert with the key id that newer scanners resolve
+    # through the server key directory, 'both' rotates all four, and
+    # 'extended' one BLE 5 advert with the whole key
+    if key_format == 'extended':
+        return [(INDEX_FULL, key)]
+    payloads = []
+    if key_format in ('split', 'both'):
+        payloads += list(enumerate(key_fragments(key), 1))
+    if key_format in ('compact', 'both'):
+        payloads.append((INDEX_COMPACT, key_id(key)))
+    return payloads
+
+
 class Advertisement(dbus.service.Object):
     PATH_BASE = '/org/bluez/example/advertisement'
 
@@ -31,6 +60,8 @@ class Advertisement(dbus.service.Object):
         self.manufacturer_data = None
         self.timeout = None
         self.duration = None
+        self.interval = None
+        self.secondary_channel = None
         self.service_uuids = None
         dbus.service.Object.__init__(self, bus, self.path)
 
@@ -45,6 +76,13 @@ class Advertisement(dbus.service.Object):
             properties['Timeout'] = dbus.UInt16(self.timeout)
         if self.duration is not None:
             properties['Duration'] = dbus.UInt16(self.duration)
+        if self.interval is not None:
+            # experimental in BlueZ; ignored by daemons that lack it
+            properties['MinInterval'] = dbus.UInt32(self.interval)
+            properties['MaxInterval'] = dbus.UInt32(self.interval)
+        if self.secondary_channel is not None:
+            # BLE 5 extended advertising, so the data may exceed 31 bytes
+            properties['SecondaryChannel'] = dbus.String(self.secondary_channel)
         if self.service_uuids is not None:
             properties['ServiceUUIDs'] = dbus.Array(self.service_uuids,
                                                     signature='s')
@@ -56,6 +94,12 @@ class Advertisement(dbus.service.Object):
     def add_duration(self, duration):
         self.duration = duration
 
+    def add_interval(self, interval_ms):
+        self.interval = interval_ms
+
+    def add_secondary_channel(self, phy):
+        self.secondary_channel = phy
+
     def add_timeout(self, timeout):
         self.timeout = timeout
 
@@ -115,6 +159,8 @@ class BeaconAdvertisement(Advertisement):
         self.add_manufacturer_data(manufacture_id, pkt_index + pkt_data)
         if timeout:
             self.add_timeout(timeout)
+        if index == INDEX_FULL:
+            self.add_secondary_channel('1M')
         self.add_duration(3)
         # self.add_duration(10)
 
@@ -165,7 +211,13 @@ class ConfigCtrl:
 
 
 class BeaconCtrl():
-    def __init__(self, mainloop, bus, key):
+    # Advertises the three key fragments on an adv_schedule.Schedule: BlueZ
+    # rotates them every `slot` seconds, and for duty cycled schedules the
+    # set is registered for `burst` seconds out of every `period`.
+    # `registered` means the schedule is running, `on_air` that the
+    # advertisements are currently registered.
+    def __init__(self, mainloop, bus, key,
+                 schedule=adv_schedule.SCHEDULES['normal'], key_format='split'):
         self.mainloop = mainloop
         adapter_path = find_adapter_path(bus, [LE_ADVERTISING_MANAGER_IFACE])
         # adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
@@ -175,17 +227,41 @@ class BeaconCtrl():
         self.manager = dbus.Interface(
             bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
             LE_ADVERTISING_MANAGER_IFACE)
+        self.bus = bus
+        self.key = key
         self.registered = False
+        self.on_air = False
+        self.timer_id = 0
         self.beacon_adv = []
-        for i in range(1, 4):
-            if i == 3:
-                self.beacon_adv.append(
-                    BeaconAdvertisement(
-                        bus, i,
-                        key[44:] + 0xFFFF.to_bytes(2, byteorder='little')))
-            else:
-                self.beacon_adv.append(
-                    BeaconAdvertisement(bus, i, key[(i - 1) * 22:i * 22]))
+        self.set_format(key_format)
+        self.set_schedule(schedule)
+
+    def set_format(self, key_format):
+        for a in self.beacon_adv:
+            if len(a._locations):
+                a.remove_from_connection()
+        self.key_format = key_format
+        self.beacon_adv = [BeaconAdvertisement(self.bus, i, data)
+                           for i, data in beacon_payloads(self.key, key_format)]
+
+    def set_schedule(self, schedule):
+        # takes effect at the next burst; restart() to apply it now
+        adverts = len(self.beacon_adv)
+        self.schedule = adv_schedule.validate(schedule, adverts)
+        for adv in self.beacon_adv:
+            adv.add_duration(schedule.slot)
+            adv.add_interval(schedule.interval_ms)
+        logger.info('beacon schedule {}: {}'.format(
+            schedule, adv_schedule.estimate(schedule, adverts)))
+
+    def update_key(self, key):
+        # reuse the exported advertisement objects; BlueZ reads the
+        # properties again when they are registered next
+        self.key = key
+        for adv, (i, data) in zip(self.beacon_adv,
+                                  beacon_payloads(key, self.key_format)):
+            adv.manufacturer_data = None
+            adv.add_manufacturer_data(ID_MANUFACTURE, [i] + list(data))
 
     def register_ad_cb(self):
         logger.info('Advertisement registered')
@@ -193,29 +269,81 @@ class BeaconCtrl():
         # 	Log('debug','path,location: ({},{})'.format(a._object_path,a._locations))
 
     def register_ad_error_cb(self, error):
+        if self.key_format == 'extended':
+            # controller without extended advertising: use the 3 fragments
+            logger.warning('Extended advertising failed ({}), falling back '
+                           'to split key fragments'.format(error))
+            GObject.idle_add(self.fall_back)
+            return
         logger.info('Failed to register advertisement: ' + str(error))
         self.mainloop.quit()
 
+    def fall_back(self):
+        running = self.registered
+        if running:
+            self.registered = False
+            if self.timer_id:
+                GObject.source_remove(self.timer_id)
+                self.timer_id = 0
+            # nothing of ours is on air after the failed registration
+            self.on_air = False
+        self.set_format('split')
+        self.set_schedule(self.schedule)
+        if running:
+            self.start()
+        return False
+
+    def burst_on(self):
+        self.timer_id = 0
+        self.on_air = True
+        for adv in self.beacon_adv:
+            self.manager.RegisterAdvertisement(
+                adv.get_path(), {},
+                reply_handler=self.register_ad_cb,
+                error_handler=self.register_ad_error_cb)
+        if not adv_schedule.continuous(self.schedule):
+            self.timer_id = GObject.timeout_add_seconds(self.schedule.burst,
+                                                        self.burst_off)
+        return False
+
+    def burst_off(self):
+        self.timer_id = 0
+        self.off_air()
+        self.timer_id = GObject.timeout_add_seconds(
+            self.schedule.period - self.schedule.burst, self.burst_on)
+        return False
+
+    def off_air(self):
+        if not self.on_air:
+            return
+        self.on_air = False
+        for adv in self.beacon_adv:
+            self.manager.UnregisterAdvertisement(adv)
+        logger.debug('Advertisement unregistered')
+
     def start(self):
         if self.registered:
             logger.warning("BeaconCtrl already started!")
             return
         logger.info("BeaconCtrl started!")
         self.registered = True
-        for i in range(0, 3):
-            self.manager.RegisterAdvertisement(
-                self.beacon_adv[i].get_path(), {},
-                reply_handler=self.register_ad_cb,
-                error_handler=self.register_ad_error_cb)
+        self.burst_on()
 
     def stop(self):
         if not self.registered:
             logger.warning("BeaconCtrl not running!")
             return
         self.registered = False
-        for i in range(0, 3):
-            self.manager.UnregisterAdvertisement(self.beacon_adv[i])
-        logger.info('Advertisement unregistered')
+        if self.timer_id:
+            GObject.source_remove(self.timer_id)
+            self.timer_id = 0
+        self.off_air()
+        logger.info('BeaconCtrl stopped')
+
+    def restart(self):
+        if self.registered:
+            self.stop()
+        self.start()
 
     def __del__(self):
         logger.info('beaconAdv object released!({})'.format(
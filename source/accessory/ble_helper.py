@@ -1,4 +1,6 @@
+import hashlib
 import logging
+import struct
 
 import dbus
 import dbus.exceptions
@@ -77,6 +79,36 @@ UUID_CONFIGSERVICE_SHORT = '361e'
 UUID_CONFIGSERVICE_WHOLE = '0000361e-0000-1000-8000-00805f9b34fb'
 UUID_CONFIGCHRC_SHORT = '361d'
 UUID_CONFIGCHRC_WHOLE = '0000361d-0000-1000-8000-00805f9b34fb'
+# first manufacturer data byte: key fragment index 1..3, config mode,
+# a compact beacon carrying KEY_ID_LEN bytes of key id, or an extended
+# (BLE 5) advertisement carrying the whole KEY_LEN-byte key
+INDEX_CONFIG = 0xFF
+INDEX_COMPACT = 0x10
+INDEX_FULL = 0x20
+KEY_ID_LEN = 16
+KEY_LEN = 64
+# GATT provisioning. A legacy write is offset u16, 0xFF, 16, then 16 key
+# bytes. A bulk write is one PROVISION_HEADER (offset, PROVISION_VERSION,
+# kind, total, length, crc32 of the whole payload) followed by `length`
+# payload bytes at `offset`; the client sends as few of them as the MTU
+# allows and reads the characteristic once for the PROVISION_STATUS ack.
+PROVISION_VERSION = 0x02
+PROVISION_HEADER = struct.Struct('<HBBHHI')
+PROVISION_STATUS = struct.Struct('<BHI')
+PROVISION_KIND_KEY = 0x01
+PROVISION_IDLE = 0x00
+PROVISION_PARTIAL = 0x01
+PROVISION_DONE = 0x02
+PROVISION_BAD_CRC = 0x03
+PROVISION_BAD_FRAME = 0x04
+# ATT_MTU before any exchange; a write carries MTU - 3 bytes of value
+ATT_DEFAULT_MTU = 23
 # Configurable
 ADAPTER_INTERFACE = BLUEZ_SERVICE_NAME + '.Adapter1'
 DEVICE_INTERFACE = BLUEZ_SERVICE_NAME + '.Device1'
+
+
+def key_id(key_bytes):
+    # compact beacon id of a 64-byte public key; the server key directory
+    # maps it back to the key
+    return hashlib.sha256(key_bytes).digest()[:KEY_ID_LEN]
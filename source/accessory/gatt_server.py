@@ -1,4 +1,5 @@
 import logging
+import zlib
 
 import dbus
 import dbus.exceptions
@@ -15,7 +16,17 @@ from ble_helper import (
     GATT_CHRC_IFACE,
     GATT_DESC_IFACE,
     InvalidArgsException,
+    KEY_LEN,
     NotSupportedException,
+    PROVISION_BAD_CRC,
+    PROVISION_BAD_FRAME,
+    PROVISION_DONE,
+    PROVISION_HEADER,
+    PROVISION_IDLE,
+    PROVISION_KIND_KEY,
+    PROVISION_PARTIAL,
+    PROVISION_STATUS,
+    PROVISION_VERSION,
     UUID_CONFIGSERVICE_SHORT,
     UUID_CONFIGCHRC_SHORT,
     find_adapter_path,
@@ -26,11 +37,11 @@ logger = logging.getLogger('BLELogger')
 
 class Application(dbus.service.Object):
 
-    def __init__(self, bus, mainloop):
+    def __init__(self, bus, mainloop, on_key=None):
         self.path = '/'
         self.services = []
         dbus.service.Object.__init__(self, bus, self.path)
-        self.add_service(ConfiguringService(bus, 0, mainloop))
+        self.add_service(ConfiguringService(bus, 0, mainloop, on_key))
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -256,44 +267,64 @@ class Descriptor(dbus.service.Object):
 
 
 class ConfiguringService(Service):
-    def __init__(self, bus, index, mainloop):
+    def __init__(self, bus, index, mainloop, on_key=None):
         Service.__init__(self, bus, index, UUID_CONFIGSERVICE_SHORT, True)
         self.add_characteristic(
-            ConfiguringCharacteristic(bus, 0, self, mainloop))
+            ConfiguringCharacteristic(bus, 0, self, mainloop, on_key))
 
 
 class ConfiguringCharacteristic(Characteristic):
-    def __init__(self, bus, index, service, mainloop):
+    def __init__(self, bus, index, service, mainloop, on_key=None):
         Characteristic.__init__(
             self,
             bus,
             index,
             UUID_CONFIGCHRC_SHORT,
             # ['read', 'write','notify'],
-            ['read', 'write'],
+            ['read', 'write', 'write-without-response'],
             service)
+        # [addr that waiting for, bytes received] during a legacy transfer,
+        # else PROVISION_STATUS
         self.status = [0, 0]
-        # [addr that waiting for, bytes received]
-        self.data = []
+        self.data = b''
+        # bulk transfer: the frame being put together from a long write,
+        # and the payload kind, size and crc32 announced by its header
+        self.frame = b''
+        self.kind = None
+        self.total = 0
+        self.crc = 0
         self.mainloop = mainloop
+        # called with the 64-byte key once written; without it the mainloop
+        # is stopped so the caller can pick the key up from AccessoryKeyPath
+        self.on_key = on_key
+        self.set_status(PROVISION_IDLE)
 
     def ReadValue(self, options):
         # Log('debug','Data Read')
         return self.status
 
     def WriteValue(self, value, options):
+        # convert from dbus.array to bytes
+        value_bytes = bytes(value)
+        att_offset = int(options.get('offset', 0))
+        if att_offset and self.frame or \
+                len(value_bytes) > 2 and value_bytes[2] == PROVISION_VERSION:
+            self.write_bulk(value_bytes, att_offset)
+            return
+        self.write_legacy(value_bytes)
+
+    def write_legacy(self, value_bytes):
         # int.from_bytes([B1~B2],'little') - addr Offset in bytes
         # int.from_bytes([B3],'little') - Reserved
         # int.from_bytes([B4],'little') - Length in bytes
-        # Log('debug','type:{}, received:{}'.format(type(value),value))
-        value_bytes = b''.join([bytes([v]) for v in value])
-        # convert from dbus.array to bytes
         offset = int.from_bytes(value_bytes[0:2], 'little')
         length = int.from_bytes(value_bytes[3:4], 'little')
         # value[3] will be convert to int directly.
-        logger.info('received {} Bytes; offset:{},length:{}'.format(
-            len(value_bytes), offset, length))
-        assert length == 16, "length error:{}".format(length)
+        logger.debug('received %d Bytes; offset:%d,length:%d',
+                     len(value_bytes), offset, length)
+        if length != 16:
+            logger.warning('length error:{}'.format(length))
+            raise InvalidArgsException()
         if (offset == 0):
             logger.warning('Reset Data')
             self.status = [0, 0]
@@ -307,26 +338,78 @@ class ConfiguringCharacteristic(Characteristic):
         self.status[1] = self.status[1] + length
         if self.status[1] == 64:
             # 64 bytes key received!(512 bit)
-            logger.info("{}Bytes received!".format(len(self.data)))
-            with open(AccessoryKeyPath, 'wb') as f:
-                logger.info('Key written to {}'.format(AccessoryKeyPath))
-                f.write(self.data)
-                f.close()
+            self.commit_key(self.data)
+
+    def write_bulk(self, value_bytes, att_offset):
+        # a long write may reach us as several prepared writes, each at its
+        # ATT offset into the frame; handle the frame once it is complete
+        if att_offset:
+            self.frame = self.frame[:att_offset] + value_bytes
+        else:
+            self.frame = value_bytes
+        if len(self.frame) < PROVISION_HEADER.size:
+            return
+        offset, _, kind, total, length, crc = \
+            PROVISION_HEADER.unpack_from(self.frame)
+        payload = self.frame[PROVISION_HEADER.size:]
+        if len(payload) < length:
+            return
+        self.frame = b''
+        logger.debug('received %d Bytes; offset:%d,length:%d,total:%d',
+                     length, offset, length, total)
+        if offset == 0:
+            self.data = b''
+            self.kind, self.total, self.crc = kind, total, crc
+        elif (kind, total, crc) != (self.kind, self.total, self.crc):
+            logger.warning('frame does not continue the current transfer')
+            self.set_status(PROVISION_BAD_FRAME)
+            return
+        if offset != len(self.data):
+            # the ack tells the client where to resume from
+            logger.warning('invalid offset')
+            return
+        self.data += payload[:length]
+        if len(self.data) < self.total:
+            self.set_status(PROVISION_PARTIAL)
+            return
+        if len(self.data) > self.total or zlib.crc32(self.data) != self.crc:
+            logger.warning('payload checksum mismatch, dropping transfer')
+            self.data = b''
+            self.set_status(PROVISION_BAD_CRC)
+            return
+        if self.kind != PROVISION_KIND_KEY or self.total != KEY_LEN:
+            logger.warning('unsupported payload kind:{}, size:{}'.format(
+                self.kind, self.total))
+            self.data = b''
+            self.set_status(PROVISION_BAD_FRAME)
+            return
+        self.set_status(PROVISION_DONE)
+        self.commit_key(self.data)
+
+    def set_status(self, state):
+        self.status = list(PROVISION_STATUS.pack(state, len(self.data), self.crc))
+
+    def commit_key(self, key):
+        logger.info("{}Bytes received!".format(len(key)))
+        with open(AccessoryKeyPath, 'wb') as f:
+            logger.info('Key written to {}'.format(AccessoryKeyPath))
+            f.write(key)
+            f.close()
+        if self.on_key is not None:
+            self.on_key(bytes(key))
+        else:
             self.mainloop.quit()
             logger.info('mainloop ended!')
-        # self.data = value
-        # Log('debug','{} Bytes Data Wrote'.format(len(self.data)))
-        # Log('debug','Raw: {}'.format(self.data))
 
 
 class GattServerCtrl():
-    def __init__(self, mainloop, bus):
+    def __init__(self, mainloop, bus, on_key=None):
         self.mainloop = mainloop
         adapter_path = find_adapter_path(bus, [GATT_MANAGER_IFACE])
         self.manager = dbus.Interface(
             bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
             GATT_MANAGER_IFACE)
-        self.application = Application(bus, self.mainloop)
+        self.application = Application(bus, self.mainloop, on_key)
         self.registered = False
 
     def register_ad_cb(self):
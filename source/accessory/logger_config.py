@@ -1,26 +1,58 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 
-def init_logger():
-		
-	logger = logging.getLogger("BLELogger")
-	logger.setLevel(logging.DEBUG)
+# per-advertisement logs are let through once every SAMPLE_EVERY calls
+SAMPLE_EVERY = 1
 
-	# fh = logging.FileHandler("BLELog.log")
-	# fh.setLevel(logging.WARN)
-	sh = logging.StreamHandler(stream=None)
-	sh.setLevel(logging.DEBUG)
+
+class Sampler():
+	# gate for logs on hot paths: if logger.isEnabledFor(..) and s.Hit()
+	def __init__(self):
+		self.count = 0
+
+	def Hit(self):
+		self.count += 1
+		return SAMPLE_EVERY <= 1 or self.count % SAMPLE_EVERY == 1
+
+
+def init_logger(level=logging.DEBUG, log_file=None, max_bytes=1 << 20,
+				backup_count=3, sample_every=1):
+	# defaults keep the old behaviour: everything at DEBUG to stderr.
+	# With log_file, records go through a queue to a listener thread that
+	# writes a rotating file, so callers never block on log I/O.
+	global SAMPLE_EVERY
+	SAMPLE_EVERY = sample_every
+	if isinstance(level, str):
+		level = logging.getLevelName(level)
+
+	logger = logging.getLogger("BLELogger")
+	logger.setLevel(level)
 
 	fmt = "%(asctime)s **%(levelname)s** %(filename)s-%(lineno)d-%(threadName)s:\n  %(message)s"
 	datefmt = "%H:%M:%S"
 	formatter = logging.Formatter(fmt, datefmt)
 
-	# fh.setFormatter(formatter)
+	sh = logging.StreamHandler(stream=None)
+	sh.setLevel(level)
 	sh.setFormatter(formatter)
-	# logger.addHandler(fh)
-	logger.addHandler(sh)
-
-	# logger.debug('debug message')
-	# logger.info('info message')
-	# logger.warning('warn message')
-	# logger.error('error message')
-	# logger.critical('critical message')
\ No newline at end of file
+	if not log_file:
+		logger.addHandler(sh)
+		return None
+
+	fh = logging.handlers.RotatingFileHandler(
+		log_file, maxBytes=max_bytes, backupCount=backup_count)
+	fh.setLevel(level)
+	fh.setFormatter(formatter)
+	# the console only gets warnings once a file is kept
+	sh.setLevel(max(level, logging.WARNING))
+
+	log_queue = queue.SimpleQueue()
+	logger.addHandler(logging.handlers.QueueHandler(log_queue))
+	listener = logging.handlers.QueueListener(
+		log_queue, sh, fh, respect_handler_level=True)
+	listener.start()
+	atexit.register(listener.stop)
+	return listener
+
@@ -0,0 +1,214 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'server'))
+sys.path.insert(0, os.path.join(HERE, '..', 'device'))
+
+import advert_filter
+import advert_log
+import bench_server
+import device
+import encryptor
+import key_management
+
+BENCHMARKS = {}
+
+
+def Benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+def Timeit(fn, number, repeat=5):
+    # best and median per-op time over `repeat` runs of `number` calls
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - start) / number)
+    return {
+        'us_per_op_min': 1e6 * min(runs),
+        'us_per_op_median': 1e6 * statistics.median(runs),
+        'ops_per_sec': 1 / min(runs),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+class NullQueue():
+    def put(self, item, block=True):
+        pass
+
+
+@Benchmark('scan.filter_data')
+def BenchFilterData(scale):
+    # RevealData path for a stream of changing fragments
+    filt = advert_filter.AdvertFilter(NullQueue())
+    adverts = list(advert_log.SynthAdverts(100, 1, 30, seed=1))
+    props = [('/bench/' + a, {'Address': a,
+                              'ManufacturerData': advert_log.ManufacturerData(p)})
+             for _, a, p in adverts]
+    it = iter(props * (1 + scale))
+
+    def step():
+        path, properties = next(it)
+        filt.FilterData(path, properties)
+    return Timeit(step, len(props) * scale // 5, 5)
+
+
+@Benchmark('device.got_message')
+def BenchGotMessage(scale):
+    # registry lookup with many known accessories, config messages only so
+    # no key completes
+    device.Accessories = device.registry.AccessoryRegistry()
+    now = datetime.datetime.now()
+    addrs = ['{:012X}'.format(i) for i in range(5000)]
+    for addr in addrs:
+        device.GotMessage(advert_filter.Sighting('config', addr, now, 255, None))
+    msgs = [advert_filter.Sighting('config', a, now, 255, None) for a in addrs]
+    it = iter(msgs * (1 + scale))
+    return Timeit(lambda: device.GotMessage(next(it)), 1000 * scale // 5, 5)
+
+
+@Benchmark('encryptor.form_key_encrypt')
+def BenchFormKeyEncrypt(scale, key_bytes=None):
+    key_bytes = key_bytes or Keys()[0]
+    location = device.GetLocation()
+
+    def step():
+        pub_key = encryptor.FormKey(key_bytes)
+        pub_key.encrypt(location, encryptor.padding.PKCS1v15())
+    return Timeit(step, 200 * scale, 5)
+
+
+@Benchmark('encryptor.make_report_cached')
+def BenchMakeReport(scale):
+    key_bytes = Keys()[0]
+    location = device.GetLocation()
+    return Timeit(lambda: encryptor.MakeReport(key_bytes, location),
+                  200 * scale, 5)
+
+
+@Benchmark('key_management.load_extract')
+def BenchLoadExtract(scale):
+    _, pri_path, pub_path = Keys()
+
+    def step():
+        key_management.LoadPriKey(pri_path)
+        key_management.ExtractPubKey(pub_path)
+    return Timeit(step, 20 * scale, 5)
+
+
+@Benchmark('server.post_get')
+def BenchServer(scale):
+    single = bench_server.Run(16, 50 * scale, 1, 64)
+    batch = bench_server.Run(16, 10 * scale, 20, 64)
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite = bench_server.Run(16, 10 * scale, 20, 64,
+                                  os.path.join(tmp, 'reports.db'))
+    return {
+        'requests_per_sec': single['requests_per_sec'],
+        'batch_reports_per_sec': batch['reports_per_sec'],
+        'sqlite_batch_reports_per_sec': sqlite['reports_per_sec'],
+        'query_requests_per_sec': single['query_requests_per_sec'],
+        'sqlite_query_requests_per_sec': sqlite['query_requests_per_sec'],
+    }
+
+
+_keys = None
+# the TemporaryDirectory holding them, removed when the run ends
+_keys_dir = None
+
+
+def Keys():
+    # one throwaway key pair for the whole run, generated offline
+    global _keys, _keys_dir
+    if _keys is None:
+        _keys_dir = tempfile.TemporaryDirectory(prefix='blebench')
+        pri_path = os.path.join(_keys_dir.name, 'priKey.pem')
+        pub_path = os.path.join(_keys_dir.name, 'pubKey.pem')
+        key_management.GenKeyPair(pri_path, pub_path)
+        key_bytes, e = key_management.ExtractPubKey(pub_path)
+        _keys = (key_bytes, pri_path, pub_path)
+    return _keys
+
+
+def GitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE, stderr=subprocess.DEVNULL
+                                       ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def Compare(results, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['results']
+        f.close()
+    for name, stats in results.items():
+        old = baseline.get(name)
+        if not old or 'error' in stats or 'error' in old:
+            continue
+        for metric, value in stats.items():
+            if metric in old and isinstance(value, float) and old[metric]:
+                print('{:32s} {:28s} {:12.2f} -> {:12.2f} ({:+.1f}%)'.format(
+                    name, metric, old[metric], value,
+                    100 * (value - old[metric]) / old[metric]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', type=str, nargs='*', default=None,
+                        help='benchmark names (prefix match)')
+    parser.add_argument('--scale', type=int, default=5,
+                        help='work multiplier; lower for a quick run')
+    parser.add_argument('--output', type=str, default=None,
+                        help='write results JSON here')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='results JSON from another commit to diff against')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('BLELogger').setLevel(logging.WARNING)
+    device.report_sink = lambda pubkey_bytes, location: None
+    results = {}
+    try:
+        for name, fn in BENCHMARKS.items():
+            if args.only and not any(name.startswith(o) for o in args.only):
+                continue
+            try:
+                results[name] = fn(args.scale)
+            except Exception as e:
+                results[name] = {'error': repr(e)}
+            print('{}: {}'.format(name, json.dumps(results[name])))
+    finally:
+        if _keys_dir is not None:
+            _keys_dir.cleanup()
+    report = {
+        'commit': GitCommit(),
+        'time': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'scale': args.scale,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.close()
+    if args.compare:
+        Compare(results, args.compare)
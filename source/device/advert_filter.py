@@ -0,0 +1,196 @@
+import collections
+import datetime
+import logging
+import time
+
+from beacon_format import (
+    ID_MANUFACTURE,
+    INDEX_COMPACT,
+    INDEX_CONFIG,
+    INDEX_FULL,
+    KEY_ID_LEN,
+    KEY_LEN,
+)
+import logger_config
+import metrics
+
+logger = logging.getLogger('BLELogger')
+
+ADVERTS = metrics.REGISTRY.Counter(
+    'ble_adverts_received_total', 'BlueZ device signals seen by the scanner')
+FORWARDED = metrics.REGISTRY.Counter(
+    'ble_adverts_forwarded_total', 'Adverts handed on to GotMessage')
+FILTER_SECONDS = metrics.REGISTRY.Histogram(
+    'ble_filter_seconds', 'Time spent filtering one device signal')
+
+reveal_log = logger_config.Sampler()
+
+# one advertisement as handed from the scanner to GotMessage. type is
+# 'beacon' (data: key fragment), 'compact' (data: key id), 'config', or
+# 'key' (data: a whole public key, e.g. resolved from a compact id)
+Sighting = collections.namedtuple('Sighting',
+                                  ['type', 'addr', 'time', 'index', 'data'])
+
+
+def AddressFromPath(path):
+    # /org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF -> AA:BB:CC:DD:EE:FF, so a record
+    # recreated after expiry from a PropertiesChanged signal (which carries
+    # no Address) still knows its device
+    name = path.rsplit('/', 1)[-1]
+    if not name.startswith('dev_'):
+        return None
+    return name[4:].replace('_', ':')
+
+
+class DeviceRecord():
+    # the few Device1 properties the scanner reads, instead of the full
+    # D-Bus property map per device
+    __slots__ = ('address', 'payload', 'rssi', 'last_seen', 'forwarded')
+
+    def __init__(self, address=None):
+        self.address = address
+        self.payload = None
+        # manufacturer data under ID_MANUFACTURE, as bytes
+        self.rssi = None
+        self.last_seen = 0.0
+        self.forwarded = None
+
+    def Update(self, properties, now):
+        # returns True when our manufacturer payload changed
+        changed = False
+        if 'Address' in properties:
+            self.address = str(properties['Address'])
+        if 'ManufacturerData' in properties:
+            payload = properties['ManufacturerData'].get(ID_MANUFACTURE)
+            if payload is not None:
+                payload = bytes(payload)
+                if payload != self.payload:
+                    self.payload = payload
+                    changed = True
+        if 'RSSI' in properties:
+            self.rssi = int(properties['RSSI'])
+        self.last_seen = now
+        return changed
+
+
+class AdvertFilter():
+    # D-Bus free part of the scanner: per-device records, signal filtering
+    # and RevealData. ScanCtrl feeds it from BlueZ, replay.py from a file.
+
+    def __init__(self, message, max_devices=1024, max_age=600, refresh=30,
+                 recorder=None):
+        self.message = message
+        self.received_num = 0
+        # path -> DeviceRecord, least recently seen first
+        self.devices = collections.OrderedDict()
+        self.max_devices = max_devices
+        self.max_age = max_age
+        self.expired_num = 0
+        # unchanged payloads are forwarded again after `refresh` seconds so
+        # GotMessage still sees the device as recent
+        self.refresh = refresh
+        self.signal_num = 0
+        self.dropped = {'no_mdata': 0, 'foreign': 0, 'unchanged': 0,
+                        'no_address': 0, 'malformed': 0}
+        # optional advert_log.AdvertRecorder capturing every payload seen
+        self.recorder = recorder
+
+    def UpdateDevice(self, path, properties, now=None):
+        if now is None:
+            now = time.monotonic()
+        record = self.devices.get(path)
+        if record is None:
+            record = DeviceRecord(AddressFromPath(path))
+            self.devices[path] = record
+        else:
+            self.devices.move_to_end(path)
+        changed = record.Update(properties, now)
+        self.ExpireDevices(now)
+        return record, changed
+
+    def ExpireDevices(self, now):
+        while self.devices:
+            record = next(iter(self.devices.values()))
+            if len(self.devices) <= self.max_devices and \
+                    now - record.last_seen <= self.max_age:
+                break
+            self.devices.popitem(last=False)
+            self.expired_num += 1
+
+    def FilterData(self, path, properties):
+        # only forward signals whose ID_MANUFACTURE payload actually changed
+        self.signal_num += 1
+        ADVERTS.Inc()
+        start = metrics.Start()
+        sighting = self._Filter(path, properties)
+        # filter cost only, not the wait for room in the queue
+        FILTER_SECONDS.ObserveSince(start)
+        if sighting is None:
+            return
+        self.message.put(sighting, block=True)
+        FORWARDED.Inc()
+
+    def _Filter(self, path, properties):
+        # the Sighting to forward, or None
+        now = time.monotonic()
+        record, changed = self.UpdateDevice(path, properties, now)
+        if 'ManufacturerData' not in properties:
+            self.dropped['no_mdata'] += 1
+            return None
+        if record.payload is None:
+            self.dropped['foreign'] += 1
+            return None
+        if record.address is None:
+            # never merge sightings of different tags under one identity
+            self.dropped['no_address'] += 1
+            return None
+        if self.recorder is not None:
+            self.recorder.Write(record.address, record.payload)
+        if not changed and record.forwarded is not None and \
+                now - record.forwarded < self.refresh:
+            self.dropped['unchanged'] += 1
+            return None
+        record.forwarded = now
+        sighting = self.RevealData(record.address, path)
+        if sighting is None:
+            self.dropped['malformed'] += 1
+        return sighting
+
+    def RevealData(self, address, path):
+        # None for a payload too short for its index, or an unknown index
+        now = datetime.datetime.now()
+        v = self.devices[path].payload
+        if not v:
+            return None
+        index = v[0]
+        if index == INDEX_FULL:
+            if len(v) < 1 + KEY_LEN:
+                return None
+        elif index == INDEX_COMPACT:
+            if len(v) < 1 + KEY_ID_LEN:
+                return None
+        elif index != INDEX_CONFIG and not 1 <= index <= 3:
+            return None
+        self.received_num += 1
+        if logger.isEnabledFor(logging.DEBUG) and reveal_log.Hit():
+            logger.debug("\n***%s : %d *** [ %s ]\nIndex:%d",
+                         now.strftime("%H:%M:%S"), self.received_num,
+                         address, index)
+        if (index == INDEX_CONFIG):
+            return Sighting('config', address, now, index, None)
+        if index == INDEX_FULL:
+            # one extended advertisement: the key needs no reassembly
+            return Sighting('key', address, now, index, v[1:1 + KEY_LEN])
+        if index == INDEX_COMPACT:
+            return Sighting('compact', address, now, index,
+                            v[1:1 + KEY_ID_LEN])
+        return Sighting('beacon', address, now, index, v[1:23])
+
+    def Stats(self):
+        return {
+            'signals': self.signal_num,
+            'forwarded': self.received_num,
+            'dropped': dict(self.dropped),
+            'devices': len(self.devices),
+            'expired': self.expired_num,
+        }
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+from beacon_format import ID_MANUFACTURE, INDEX_FULL
+
+# Advertisement stream format, one JSON object per line:
+#   {"t": <seconds since start>, "addr": "AA:BB:..", "mdata": "<hex payload>"}
+# mdata is the manufacturer data under ID_MANUFACTURE: index byte + fragment.
+
+
+class AdvertRecorder():
+    def __init__(self, path):
+        self.f = open(path, 'w')
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.written_num = 0
+
+    def Write(self, address, payload, t=None):
+        if t is None:
+            t = time.monotonic() - self.start
+        line = json.dumps({'t': round(t, 6), 'addr': address,
+                           'mdata': payload.hex()})
+        with self.lock:
+            self.f.write(line + '\n')
+            self.written_num += 1
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def ReadAdverts(path):
+    # yields (t, address, payload)
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            advert = json.loads(line)
+            yield advert['t'], advert['addr'], bytes.fromhex(advert['mdata'])
+        f.close()
+
+
+def KeyFragments(key):
+    # the three beacon payloads for a 64-byte key, as BeaconCtrl sends them
+    return [
+        bytes([1]) + key[0:22],
+        bytes([2]) + key[22:44],
+        bytes([3]) + key[44:] + 0xFFFF.to_bytes(2, byteorder='little'),
+    ]
+
+
+def SynthAdverts(tags, hz, duration, seed=None, extended=False):
+    # N tags, each advertising at `hz`, rotating through its 3 fragments
+    # (or repeating one extended advert with the whole key).
+    # yields (t, address, payload), in time order within each 1/hz step
+    rng = random.Random(seed)
+    fleet = []
+    for _ in range(tags):
+        address = ':'.join('{:02X}'.format(rng.randrange(256)) for _ in range(6))
+        # little-endian 512-bit odd modulus, like key_management.ExtractPubKey
+        key = bytearray(rng.randrange(256) for _ in range(64))
+        key[0] |= 0x01
+        key[63] |= 0x80
+        key = bytes(key)
+        if extended:
+            payloads = [bytes([INDEX_FULL]) + key]
+        else:
+            payloads = KeyFragments(key)
+        fleet.append((address, payloads, rng.random() / hz))
+    for step in range(int(duration * hz)):
+        for address, payloads, phase in fleet:
+            yield step / hz + phase, address, payloads[step % len(payloads)]
+
+
+def ManufacturerData(payload):
+    # Device1-style properties for one advertisement
+    return {ID_MANUFACTURE: payload}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', type=str)
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--hz', type=float, default=1.0)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--extended', action='store_true',
+                        help='one BLE 5 advert with the whole key per tag')
+    args = parser.parse_args()
+    recorder = AdvertRecorder(args.output)
+    adverts = sorted(SynthAdverts(args.tags, args.hz, args.duration, args.seed,
+                                  args.extended))
+    for t, address, payload in adverts:
+        recorder.Write(address, payload, t)
+    recorder.close()
+    print('{} adverts written to {}'.format(recorder.written_num,
+                                            os.path.abspath(args.output)))
@@ -0,0 +1,19 @@
+import hashlib
+
+# Beacon payload format, kept free of D-Bus so replay.py and the benchmarks
+# run without BlueZ bindings; ble_helper re-exports it.
+ID_MANUFACTURE = 0x6B5A
+# first manufacturer data byte: key fragment index 1..3, config mode,
+# a compact beacon carrying KEY_ID_LEN bytes of key id, or an extended
+# (BLE 5) advertisement carrying the whole KEY_LEN-byte key
+INDEX_CONFIG = 0xFF
+INDEX_COMPACT = 0x10
+INDEX_FULL = 0x20
+KEY_ID_LEN = 16
+KEY_LEN = 64
+
+
+def KeyId(key_bytes):
+    # compact beacon id of a 64-byte public key; the server key directory
+    # maps it back to the key
+    return hashlib.sha256(key_bytes).digest()[:KEY_ID_LEN]
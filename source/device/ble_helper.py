@@ -1,8 +1,19 @@
 import logging
+import struct
 
 import dbus
 import dbus.exceptions
 
+from beacon_format import (  # noqa: F401
+    ID_MANUFACTURE,
+    INDEX_COMPACT,
+    INDEX_CONFIG,
+    INDEX_FULL,
+    KEY_ID_LEN,
+    KEY_LEN,
+    KeyId,
+)
+
 logger = logging.getLogger('BLELogger')
 
 # PATH
@@ -70,13 +81,28 @@ def RevealDbus(bus):
 
 
 # UUID
-ID_MANUFACTURE = 0x6B5A
 UUID_BEACONSERVICE_SHORT = "361f"
 UUID_BEACONSERVICE_WHOLE = '0000361f-0000-1000-8000-00805f9b34fb'
 UUID_CONFIGSERVICE_SHORT = '361e'
 UUID_CONFIGSERVICE_WHOLE = '0000361e-0000-1000-8000-00805f9b34fb'
 UUID_CONFIGCHRC_SHORT = '361d'
 UUID_CONFIGCHRC_WHOLE = '0000361d-0000-1000-8000-00805f9b34fb'
+# GATT provisioning. A legacy write is offset u16, 0xFF, 16, then 16 key
+# bytes. A bulk write is one PROVISION_HEADER (offset, PROVISION_VERSION,
+# kind, total, length, crc32 of the whole payload) followed by `length`
+# payload bytes at `offset`; the client sends as few of them as the MTU
+# allows and reads the characteristic once for the PROVISION_STATUS ack.
+PROVISION_VERSION = 0x02
+PROVISION_HEADER = struct.Struct('<HBBHHI')
+PROVISION_STATUS = struct.Struct('<BHI')
+PROVISION_KIND_KEY = 0x01
+PROVISION_IDLE = 0x00
+PROVISION_PARTIAL = 0x01
+PROVISION_DONE = 0x02
+PROVISION_BAD_CRC = 0x03
+PROVISION_BAD_FRAME = 0x04
+# ATT_MTU before any exchange; a write carries MTU - 3 bytes of value
+ATT_DEFAULT_MTU = 23
 # Configurable
 ADAPTER_INTERFACE = BLUEZ_SERVICE_NAME + '.Adapter1'
 DEVICE_INTERFACE = BLUEZ_SERVICE_NAME + '.Device1'
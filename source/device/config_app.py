@@ -3,8 +3,10 @@ import datetime
 import logging
 import threading
 import time
+import zlib
 
 import dbus
+import dbus.exceptions
 from gi.repository import GObject
 
 import key_management
@@ -15,17 +17,27 @@ from ble_helper import (
     DEVICE_INTERFACE,
     GATT_SERVICE_IFACE,
     GATT_CHRC_IFACE,
+    ATT_DEFAULT_MTU,
+    PROVISION_DONE,
+    PROVISION_HEADER,
+    PROVISION_KIND_KEY,
+    PROVISION_STATUS,
+    PROVISION_VERSION,
     UUID_CONFIGCHRC_WHOLE,
 )
 
 logger = logging.getLogger('BLELogger')
 
+# bulk: the whole key in one write (write without response when it fits
+# the MTU, else a long write) and one status read acking it by crc32;
+# accessories that do not answer the bulk ack get the legacy transfer:
 # check status every 4 packets,
 # 16bytes data per packet (20 bytes per PDU)
 class GattClient():
-    def __init__(self, mainloop, bus):
+    def __init__(self, mainloop, bus, bulk=True):
         self.mainloop = mainloop
         self.bus = bus
+        self.bulk = bulk
         self.registered = False
         self.chrcs = None
         self.chrcs_path = None
@@ -55,8 +67,9 @@ class GattClient():
                 time.sleep(1)
             else:
                 self.packet_startfrom = 0
-                self.transfer_Round = 0
+                self.transfer_round = 0
                 self.key_data, e = key_management.ExtractPubKey()
+                self.crc = zlib.crc32(self.key_data)
                 return
         self.generic_error_cb('Can not find GATT Chrcs')
 
@@ -88,13 +101,82 @@ class GattClient():
             print('GATT Chrcs was removed')
             self.mainloop.quit()
 
+    def Mtu(self):
+        # negotiated by bluetoothd on connect; the property needs BlueZ 5.62+
+        try:
+            return int(self.chrcs.Get(GATT_CHRC_IFACE, 'MTU',
+                                      dbus_interface=DBUS_PROP_IFACE))
+        except dbus.exceptions.DBusException:
+            return ATT_DEFAULT_MTU
+
+    def Finish(self):
+        logger.info('data transfer finish in {:.2f}s'.format(
+            time.monotonic() - self.started))
+        self.mainloop.quit()
+
+    def WriteBulk(self, offset=0, reliable=False):
+        data = self.key_data[offset:]
+        frame = PROVISION_HEADER.pack(offset, PROVISION_VERSION,
+                                      PROVISION_KIND_KEY, len(self.key_data),
+                                      len(data), self.crc) + data
+        # without response when one PDU carries it; otherwise a write
+        # request, which bluetoothd turns into a long (prepare/execute) write
+        if not reliable and len(frame) <= self.Mtu() - 3:
+            options = {'type': 'command'}
+        else:
+            options = {'type': 'request'}
+        logger.info('Write {} bytes ({})'.format(len(frame), options['type']))
+        self.chrcs.WriteValue(
+            frame,
+            options,
+            reply_handler=self.ReadAck,
+            error_handler=self.BulkError,
+            dbus_interface=GATT_CHRC_IFACE)
+
+    def ReadAck(self):
+        self.chrcs.ReadValue({},
+                             reply_handler=self.CheckAck,
+                             error_handler=self.BulkError,
+                             dbus_interface=GATT_CHRC_IFACE)
+
+    def CheckAck(self, value):
+        value = bytes(value)
+        if len(value) != PROVISION_STATUS.size:
+            self.Legacy('accessory has no bulk transfer')
+            return
+        state, received, crc = PROVISION_STATUS.unpack(value)
+        logger.info('{} Bytes transferred'.format(received))
+        if state == PROVISION_DONE and crc == self.crc:
+            self.Finish()
+        elif self.transfer_round == 4:
+            logger.error('Fail to write key!')
+            self.generic_error_cb('fail to write!')
+        else:
+            # resume after what the accessory holds, acknowledged this time
+            self.transfer_round += 1
+            if received >= len(self.key_data) or crc != self.crc:
+                received = 0
+            self.WriteBulk(received, reliable=True)
+
+    def BulkError(self, error):
+        if self.transfer_round:
+            self.generic_error_cb(error)
+            return
+        self.Legacy('bulk write failed ({})'.format(error))
+
+    def Legacy(self, reason):
+        logger.info('{}, using 16 byte writes'.format(reason))
+        self.bulk = False
+        self.packet_startfrom = 0
+        self.transfer_round = 0
+        self.WriteKeyData()
+
     def CheckStatus(self, value):
         # print(value)
         received_pkt = int(int(value[1]) / 16)
         logger.info('{} Bytes transferred'.format(int(value[1])))
         if received_pkt == 4:
-            logger.info('data transfer finish')
-            self.mainloop.quit()
+            self.Finish()
         else:
             if self.transfer_round == 4:
                 logger.error('Fail to write key!')
@@ -133,7 +215,11 @@ class GattClient():
             logger.error('no valid chrcs!!')
             self.generic_error_cb('no valid chrcs!!')
             return
-        self.WriteKeyData()
+        self.started = time.monotonic()
+        if self.bulk:
+            self.WriteBulk()
+        else:
+            self.WriteKeyData()
         # self.chrcs.ReadValue({},reply_handler = self.revealContent,
         # 							error_handler=self.generic_error_cb,
         #                             dbus_interface=GATT_CHRC_IFACE)
@@ -155,11 +241,9 @@ class GattClient():
         # dbus.service.Object.remove_from_connection(self.application)
 
 
-def SelectDevice(Accessories):
-    for acc in Accessories:
-        if (acc.last_seen -
-                datetime.datetime.now()) < datetime.timedelta(minutes=1):
-            return acc.addr
+def SelectDevice(Accessories, within=datetime.timedelta(minutes=1)):
+    for acc in Accessories.Recent(within):
+        return acc.addr
     return None
 
 def GetDevice(bus, addr):
@@ -178,8 +262,11 @@ def GetDevice(bus, addr):
 
 class ConfigThread(threading.Thread):
     
-    def __init__(self, Accessories):
+    def __init__(self, Accessories, select_window=60, poll=5, bulk=True):
         self.Accessories = Accessories
+        self.select_window = datetime.timedelta(seconds=select_window)
+        self.poll = poll
+        self.bulk = bulk
         self.mainloop = None
         self.gattClient = None
         self._stop = False
@@ -193,10 +280,10 @@ class ConfigThread(threading.Thread):
         # while (SelectDevice(self.Accessories) is None):
         while True:
             logger.debug('Accessory Num:{}'.format(len(self.Accessories)))
-            addr = SelectDevice(self.Accessories)
+            addr = SelectDevice(self.Accessories, self.select_window)
             if addr is not None:
                 break
-            time.sleep(5)
+            time.sleep(self.poll)
             if self._stop:
                 return
         device = GetDevice(bus, addr)
@@ -214,7 +301,7 @@ class ConfigThread(threading.Thread):
             time.sleep(1)
             if self._stop:
                 return
-        self.gattClient = GattClient(self.mainloop, bus)
+        self.gattClient = GattClient(self.mainloop, bus, self.bulk)
         self.gattClient.start()
         logger.info('mainloop run')
         self.mainloop.run()
@@ -0,0 +1,100 @@
+import logging
+import queue
+import time
+
+import metrics
+
+logger = logging.getLogger('BLELogger')
+
+BLOCKED = metrics.REGISTRY.Counter(
+    'ble_queue_blocked_total', 'Producer puts that waited on a full queue')
+HANDLE_SECONDS = metrics.REGISTRY.Histogram(
+    'ble_message_handle_seconds', 'Time spent handling one queued message')
+
+
+class MessageQueue(queue.Queue):
+    # queue.Queue that keeps depth and backpressure stats for the producer side
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.put_num = 0
+        self.blocked_num = 0
+        self.high_water = 0
+
+    def put(self, item, block=True, timeout=None):
+        try:
+            super().put(item, block=False)
+        except queue.Full:
+            if not block:
+                raise
+            # producer has to wait for the consumer: count it as backpressure
+            self.blocked_num += 1
+            BLOCKED.Inc()
+            super().put(item, block=True, timeout=timeout)
+        self.put_num += 1
+        depth = self.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+
+
+class MessageConsumer():
+    def __init__(self, message, handler, batch_size=32, report_interval=60):
+        self.message = message
+        self.handler = handler
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        metrics.REGISTRY.Gauge('ble_queue_depth',
+                               'Messages waiting for the consumer',
+                               fn=message.qsize)
+        self.consumed_num = 0
+        self.batch_num = 0
+        self.max_batch = 0
+        self._stop = False
+
+    def DrainBatch(self, timeout=1.0):
+        # block until the first message arrives, then take whatever is queued
+        try:
+            batch = [self.message.get(block=True, timeout=timeout)]
+        except queue.Empty:
+            return 0
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.message.get(block=False))
+            except queue.Empty:
+                break
+        for msg in batch:
+            start = metrics.Start()
+            try:
+                self.handler(msg)
+            except Exception:
+                logger.exception('failed to handle msg:{}'.format(msg))
+            HANDLE_SECONDS.ObserveSince(start)
+        self.consumed_num += len(batch)
+        self.batch_num += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        return len(batch)
+
+    def Stats(self):
+        stats = {
+            'depth': self.message.qsize(),
+            'consumed': self.consumed_num,
+            'batches': self.batch_num,
+            'max_batch': self.max_batch,
+        }
+        if isinstance(self.message, MessageQueue):
+            stats['put'] = self.message.put_num
+            stats['blocked'] = self.message.blocked_num
+            stats['high_water'] = self.message.high_water
+        return stats
+
+    def run(self):
+        last_report = time.monotonic()
+        while not self._stop:
+            self.DrainBatch()
+            now = time.monotonic()
+            if self.report_interval and \
+                    now - last_report >= self.report_interval:
+                logger.info('Queue stats: {}'.format(self.Stats()))
+                last_report = now
+
+    def stop(self):
+        self._stop = True
@@ -0,0 +1,71 @@
+import base64
+import concurrent.futures
+import logging
+import os
+
+from cryptography.hazmat.primitives.asymmetric import padding
+
+import key_management
+
+logger = logging.getLogger('BLELogger')
+
+
+def DecryptChunk(chunk, pri_key_path=None):
+    # runs in a worker: each private key is loaded once per worker process
+    pri_key = key_management.CachedPriKey(pri_key_path)
+    decrypted = []
+    for timestamp, content in chunk:
+        try:
+            plain = pri_key.decrypt(base64.b64decode(content), padding.PKCS1v15())
+        except ValueError as e:
+            logger.warning('skip undecryptable report at {}: {}'.format(
+                timestamp, e))
+            continue
+        decrypted.append((timestamp, plain))
+    return decrypted
+
+
+class BulkDecryptor():
+    # Decrypts batches of query results across a worker pool and returns
+    # (timestamp, plaintext) sorted by timestamp. Small batches are decrypted
+    # inline where pool overhead would dominate.
+    def __init__(self, workers=None, kind='process', inline_below=64):
+        self.workers = workers or os.cpu_count() or 1
+        self.inline_below = inline_below
+        if kind == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+    def Decrypt(self, results, pri_key_path=None):
+        return self.DecryptMany({None: (pri_key_path, results)})[None]
+
+    def DecryptMany(self, batches):
+        # batches: {name: (pri_key_path, results)}; chunks of every key are
+        # queued together so a fleet query keeps all workers busy
+        total = sum(len(results) for _, results in batches.values())
+        inline = total < self.inline_below or self.workers == 1
+        # a few chunks per worker keeps them busy without per-item IPC
+        size = max(1, -(-total // (self.workers * 4)))
+        futures = {}
+        decrypted = {}
+        for name, (pri_key_path, results) in batches.items():
+            items = [(r['timestamp'], r['content']) for r in results]
+            if inline:
+                decrypted[name] = DecryptChunk(items, pri_key_path)
+                continue
+            futures[name] = [
+                self.executor.submit(DecryptChunk, items[i:i + size],
+                                     pri_key_path)
+                for i in range(0, len(items), size)
+            ]
+        for name, parts in futures.items():
+            decrypted[name] = []
+            for part in parts:
+                decrypted[name].extend(part.result())
+        for plain in decrypted.values():
+            plain.sort(key=lambda d: d[0])
+        return decrypted
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
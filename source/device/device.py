@@ -1,40 +1,54 @@
 import argparse
+import asyncio
 import base64
 import datetime
 import logging
-import queue
-import time
+import signal
+import threading
 
 import requests
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.asymmetric import rsa
 
-import config_app
+import advert_filter
+import advert_log
+import consumer
+import decryptor
+import encryptor
 import key_management
+import keydir
+import keystore
 import logger_config
-import scan
+import metrics
+import owner_cache
+import pipeline
+import registry
+import settings
+import sighting_filter
+import uploader
+
+logger = logging.getLogger('BLELogger')
+
+FRAGMENTS = metrics.REGISTRY.Counter(
+    'ble_key_fragments_total', 'New key fragments recorded')
+KEYS_COMPLETED = metrics.REGISTRY.Counter(
+    'ble_keys_completed_total', 'Public keys fully reassembled')
+SUPPRESSED = metrics.REGISTRY.Counter(
+    'ble_reports_suppressed_total', 'Completed keys not reported again yet')
+
+message_log = logger_config.Sampler()
+
+# defaults until __main__ loads the profile, config file, env and flags
+conf = settings.Settings()
 
 
 def GetLocation():
     return "Hello!".encode('utf-8')
 
 
-def FormKey(key_bytes):
-    e = 65537
-    n = int.from_bytes(key_bytes, 'little')
-    key_num = rsa.RSAPublicNumbers(e=e, n=n)
-    pub_key = key_num.public_key(backend=default_backend())
-    return pub_key
+sightings = sighting_filter.SightingFilter()
 
 
 def Upload(dataJSON):
-    url = "https://bletracker.supportvector.com/ble/register"
-    r = requests.post(url, json=dataJSON)
-    if r.status_code == 200 and r.json().get('code', -1) == 0:
-        logger.info("Uploaded!")
-    else:
-        logger.info("Upload failed. {}".format(r.text))
+    upload_proc.Add(dataJSON)
     # if server_on:
     #     conn = http.client.HTTPConnection('localhost', 8888)
     #     conn.request('POST', '',
@@ -46,97 +60,160 @@ def Upload(dataJSON):
     #     logger.info("(Fake)Uploaded to server")
 
 
+# key fragments as (offset, length) into the 64-byte modulus, by index
+KEY_FRAGMENTS = {1: (0, 22), 2: (22, 22), 3: (44, 20)}
+KEY_READY = 0b111
+
+
 class Accessory():
     def __init__(self, addr):
         self.addr = addr
-        self.key = [[], [], []]
+        self.key = bytearray(64)
+        self.key_filled = 0
+        # bitmask of fragments recorded so far
         self.last_seen = None
 
     def ResetKey(self):
         logger.debug('Reset Key!')
-        self.key = [[], [], []]
+        self.key_filled = 0
 
     def RecordKey(self, index, key):
         assert index > 0 and index <= 3, "invalid key index:{}".format(index)
-        if (len(self.key[index - 1]) == 0):
-            # self.key[index - 1] = key
-            if index == 3:
-                self.key[index - 1] = key[:-2]
-            else:
-                self.key[index - 1] = key
+        bit = 1 << (index - 1)
+        if not (self.key_filled & bit):
+            offset, length = KEY_FRAGMENTS[index]
+            if len(key) < length:
+                logger.debug('%s: short key fragment %d (%d bytes)',
+                             self.addr, index, len(key))
+                return
+            # fragment 3 carries 0xFFFF padding after the last 20 bytes
+            self.key[offset:offset + length] = memoryview(key)[:length]
+            self.key_filled |= bit
+            FRAGMENTS.Inc()
             if self.KeyReady():
+                KEYS_COMPLETED.Inc()
                 self.UploadAcc()
-        logger.debug("updated key:{}".format(self.key))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("updated key:%s", self.key.hex())
 
     def KeyReady(self):
-        check_1 = (len(self.key[0]) == 22)
-        check_2 = (len(self.key[1]) == 22)
-        check_3 = (len(self.key[2]) == 20)
-        return (check_1 and check_2 and check_3)
+        return self.key_filled == KEY_READY
 
     def UploadAcc(self):
         # print("{} Found!".format(self.addr))
-        location = GetLocation()
-        pubkey_bytes = b''
-        for i in range(3):
-            pubkey_bytes += b''.join(self.key[i])
-        logger.debug('{}'.format(pubkey_bytes))
-        pubKey = FormKey(pubkey_bytes)
-        # encrypted = base64.b64encode(pubKey.encrypt(location,padding.PKCS1v15()))
-        encrypted = pubKey.encrypt(location, padding.PKCS1v15())
-        for_upload = {
-            'key': base64.b64encode(pubkey_bytes).decode('utf-8'),
-            'content': base64.b64encode(encrypted).decode('utf-8')
-        }
-        logger.debug('\nkey:{},content:{}'.format(pubkey_bytes.hex(), encrypted.hex()))
-        logger.debug('forUpload:{}'.format(for_upload))
-        Upload(for_upload)
-
-
-Accessories = []
-
-
-# TODO: daily clean up on Acc list
+        ReportKey(bytes(self.key), self.addr)
+
+
+def ReportKey(pubkey_bytes, addr):
+    location = GetLocation()
+    if not sightings.ShouldSend(pubkey_bytes, location):
+        logger.debug('%s suppressed, reported recently', addr)
+        SUPPRESSED.Inc()
+        return
+    report_sink(pubkey_bytes, location)
+
+
+def ReportNow(pubkey_bytes, location):
+    Upload(encryptor.MakeReport(pubkey_bytes, location))
+
+
+# where completed keys go: encrypted inline by default, or handed to the
+# async pipeline in --pipeline asyncio mode
+report_sink = ReportNow
+
+
+Accessories = registry.AccessoryRegistry()
+
+# keydir.KeyDirectory resolving compact beacons; None ignores them
+key_directory = None
+
+
 def GotMessage(msg):
-    # 	self.message.put({'type':'config',
-    # 					'addr':address.encode('ascii', 'replace'),
-    # 					'time':datetime.datetime.now()},block=True)
-    # 	self.message.put({'type':'beacon',
-    # 					'addr':address.encode('ascii', 'replace'),
-    # 					'time':datetime.datetime.now(),
-    # 					'index':int(v[0]),
-    # 					'data':[bytes([d]) for d in v[1:23]]},block=True)
-    logger.info("-- Got msg! \n{}".format(msg))
-    for acc in Accessories:
-        if acc.addr == msg['addr']:
-            logger.info('acc:{} existed!'.format(acc.addr))
-            acc.last_seen = msg['time']
-            if msg['type'] == 'beacon':
-                if acc.last_seen is None or \
-                        ((msg['time'] - acc.last_seen) > datetime.timedelta(minutes=2)):
-                    acc.ResetKey()
-                acc.RecordKey(int(msg['index']), msg['data'])
-            return
-    acc = Accessory(msg['addr'])
-    acc.last_seen = msg['time']
-    if msg['type'] == 'beacon':
-        acc.RecordKey(int(msg['index']), msg['data'])
-    Accessories.append(acc)
-
-
-def QueryAccessoryInfo(pub_key):
-    url = "https://bletracker.supportvector.com/ble/query"
-    r = requests.post(url, json={'key': base64.b64encode(pub_key).decode('utf-8')})
-    # example response: {"code":0,"results":[{"content":"encrypted content","timestamp":1621498817959}]}
-    if r.status_code != 200 or r.json().get('code', -1) != 0:
-        logger.info("Query failed. {}".format(r.text))
+    # msg: advert_filter.Sighting(type, addr, time, index, data)
+    if logger.isEnabledFor(logging.DEBUG) and message_log.Hit():
+        logger.debug("-- Got msg! \n%s", msg)
+    if msg.type == 'key':
+        # whole key in one message: no reassembly state needed
+        ReportKey(msg.data, msg.addr)
         return
-    results = r.json().get('results', [])
-    # todo: decrypt and show results
-    priKey = key_management.LoadPriKey()
-    for result in results:
-        decrypted = priKey.decrypt(base64.b64decode(result['content']), padding.PKCS1v15())
-        logger.info('Decrypted result: {}'.format(decrypted))
+    if msg.type == 'compact':
+        if key_directory is not None:
+            pubkey_bytes = key_directory.Lookup(msg.data, msg.addr, msg.time)
+            if pubkey_bytes is not None:
+                ReportKey(pubkey_bytes, msg.addr)
+        return
+    acc = Accessories.Get(msg.addr)
+    if acc is None:
+        acc = Accessory(msg.addr)
+        Accessories.Add(acc)
+    else:
+        if msg.type == 'beacon':
+            if acc.last_seen is None or \
+                    ((msg.time - acc.last_seen) >
+                     datetime.timedelta(seconds=conf.reset_window)):
+                acc.ResetKey()
+    Accessories.Touch(acc, msg.time)
+    if msg.type == 'beacon':
+        acc.RecordKey(msg.index, msg.data)
+    Accessories.Evict(msg.time)
+
+
+QUERY_PATH = '/ble/query'
+
+
+def QueryPages(pub_key, cursor=None, since=None, limit=100):
+    # yields (results, cursor) per page; servers without paging answer
+    # everything in one page with no cursor
+    url = conf.Url(QUERY_PATH)
+    session = requests.Session()
+    while True:
+        body = {'key': base64.b64encode(pub_key).decode('utf-8'), 'limit': limit}
+        if cursor:
+            body['cursor'] = cursor
+        elif since:
+            body['since'] = since
+        r = session.post(url, json=body, timeout=10)
+        # example response: {"code":0,"results":[{"content":"encrypted content","timestamp":1621498817959}],
+        #                    "cursor":"1621498817959:42","more":false}
+        if r.status_code != 200 or r.json().get('code', -1) != 0:
+            logger.info("Query failed. {}".format(r.text))
+            return
+        data = r.json()
+        cursor = data.get('cursor', cursor)
+        yield data.get('results', []), cursor
+        if not data.get('more', False):
+            return
+
+
+def NewResults(results, cursor, last_timestamp):
+    # servers that ignore cursor/since answer with the whole history again;
+    # without a cursor to trust, drop what the cache already holds
+    if cursor or last_timestamp is None:
+        return results
+    return [r for r in results if r['timestamp'] > last_timestamp]
+
+
+def QueryAccessoryInfo(pub_key, workers=None):
+    cache = owner_cache.ResultCache()
+    cursor, last_timestamp = cache.Resume(pub_key)
+    since = last_timestamp + 1 if last_timestamp is not None else None
+    bulk = decryptor.BulkDecryptor(workers)
+    new_num = 0
+    try:
+        for results, cursor in QueryPages(pub_key, cursor, since, limit=500):
+            # decrypt each page as it arrives instead of holding the whole history
+            results = NewResults(results, cursor, last_timestamp)
+            for timestamp, decrypted in bulk.Decrypt(results):
+                logger.info('Decrypted result: {}'.format(decrypted))
+                cache.Append(pub_key, timestamp, decrypted)
+                # reports BulkDecryptor could not decrypt are not counted
+                new_num += 1
+            cache.SetCursor(pub_key, cursor)
+            cache.Save()
+    finally:
+        bulk.shutdown()
+    logger.info('{} new results, {} cached in total'.format(
+        new_num, len(cache.Results(pub_key))))
 
     # # pubkey_bytes,e = key_management.ExtractPubKey()
     # conn = http.client.HTTPConnection('localhost', 8888)
@@ -149,11 +226,163 @@ def QueryAccessoryInfo(pub_key):
     # logger.info('Decrypted result: {}'.format(decrypted))
 
 
-if __name__ == '__main__':
-    logger_config.init_logger()
-    global logger
-    logger = logging.getLogger('BLELogger')
+def QueryManyPages(resume, limit=500):
+    # resume: {pub_key: (cursor, since)}. One request per round asks about
+    # every key that still has more; yields {pub_key: (results, cursor)}
+    session = requests.Session()
+    pending = dict(resume)
+    while pending:
+        entries = []
+        for pub_key, (cursor, since) in pending.items():
+            entry = {'key': base64.b64encode(pub_key).decode('utf-8')}
+            if cursor:
+                entry['cursor'] = cursor
+            elif since:
+                entry['since'] = since
+            entries.append(entry)
+        r = session.post(conf.Url(QUERY_PATH),
+                         json={'keys': entries, 'limit': limit}, timeout=30)
+        if r.status_code != 200 or r.json().get('code', -1) != 0:
+            logger.info("Query failed. {}".format(r.text))
+            return
+        answer = r.json().get('results', {})
+        page = {}
+        for pub_key in list(pending):
+            result = answer.get(base64.b64encode(pub_key).decode('utf-8'), {})
+            cursor = result.get('cursor', pending[pub_key][0])
+            page[pub_key] = (result.get('results', []), cursor)
+            if result.get('more', False):
+                pending[pub_key] = (cursor, None)
+            else:
+                del pending[pub_key]
+        yield page
+
+
+def QueryFleet(key_store, workers=None):
+    cache = owner_cache.ResultCache()
+    labels = {key_store.PubKey(label): label for label in key_store.Labels()}
+    resume = {}
+    last_timestamps = {}
+    for pub_key in labels:
+        cursor, last_timestamp = cache.Resume(pub_key)
+        since = last_timestamp + 1 if last_timestamp is not None else None
+        resume[pub_key] = (cursor, since)
+        last_timestamps[pub_key] = last_timestamp
+    bulk = decryptor.BulkDecryptor(workers)
+    try:
+        for page in QueryManyPages(resume):
+            batches = {}
+            for pub_key, (results, cursor) in page.items():
+                results = NewResults(results, cursor, last_timestamps[pub_key])
+                if results:
+                    batches[pub_key] = (key_store.PriKeyPath(labels[pub_key]),
+                                        results)
+            for pub_key, plain in bulk.DecryptMany(batches).items():
+                for timestamp, decrypted in plain:
+                    logger.info('[{}] Decrypted result: {}'.format(
+                        labels[pub_key], decrypted))
+                    cache.Append(pub_key, timestamp, decrypted)
+            for pub_key, (results, cursor) in page.items():
+                cache.SetCursor(pub_key, cursor)
+            cache.Save()
+    finally:
+        bulk.shutdown()
+    for pub_key, label in labels.items():
+        logger.info('{}: {} results cached'.format(
+            label, len(cache.Results(pub_key))))
+
+
+def ScanOptions():
+    return {
+        'max_devices': conf.scan_max_devices,
+        'max_age': conf.scan_max_age,
+        'refresh': conf.scan_refresh,
+        'duplicate_data': conf.duplicate_data,
+    }
+
+
+def RetuneScan(scan_ctrl):
+    # scan_ctrl is None until the scan thread has set it up
+    if scan_ctrl is None:
+        return
+    scan_ctrl.max_devices = conf.scan_max_devices
+    scan_ctrl.max_age = conf.scan_max_age
+    scan_ctrl.refresh = conf.scan_refresh
+
+
+def ApplySettings(conf, changed=None):
+    sightings.window = datetime.timedelta(seconds=conf.report_window)
+    sightings.min_distance = conf.report_min_distance
+    Accessories.max_age = datetime.timedelta(seconds=conf.accessory_max_age)
+    if key_directory is not None:
+        key_directory.url = conf.Url(keydir.KEYS_PATH)
+        key_directory.capacity = conf.keydir_capacity
+        key_directory.miss_ttl = conf.keydir_miss_ttl
+
+
+def StartKeyDirectory(message):
+    # resolved compact beacons come back through the scanner's queue
+    global key_directory
+    key_directory = keydir.KeyDirectory(
+        conf.Url(keydir.KEYS_PATH),
+        lambda addr, when, key: message.put(
+            advert_filter.Sighting('key', addr, when, None, key), block=True),
+        conf.keydir_capacity, conf.keydir_miss_ttl)
+    key_directory.start()
+
+
+def RegisterOwnerKey():
+    # let scanners resolve this tag's compact beacons
+    pubkey_bytes, _ = key_management.ExtractPubKey()
+    try:
+        key_id = keydir.RegisterKey(conf.Url(keydir.KEYS_PATH), pubkey_bytes)
+        logger.info('Key registered, id:{}'.format(key_id.hex()))
+    except (requests.RequestException, ValueError) as e:
+        logger.warning('Key not registered with the directory: {}'.format(e))
+
+
+def RetuneUpload(conf, changed=None):
+    upload_proc.url = conf.Url(uploader.REGISTER_PATH)
+    upload_proc.batch_size = conf.upload_batch
+    upload_proc.flush_interval = conf.upload_interval
+    upload_proc.timeout = conf.upload_timeout
 
+
+def LogStats():
+    logger.info('Key cache stats: {}'.format(encryptor.key_cache.Stats()))
+    logger.info('Sighting stats: {}'.format(sightings.Stats()))
+    if key_directory is not None:
+        logger.info('Key directory stats: {}'.format(key_directory.Stats()))
+
+
+async def RunAsyncScanner(role, encrypt_pool=None, recorder=None):
+    global report_sink
+    stream = scan.SightingStream(asyncio.get_running_loop(),
+                                 maxsize=conf.queue_size)
+    pipe = pipeline.AsyncPipeline(GotMessage, encryptor.MakeReport, Upload,
+                                  pool=encrypt_pool)
+    report_sink = pipe.Submit
+    StartKeyDirectory(stream)
+    scan_thread = scan.ScanProc(stream, recorder, **ScanOptions())
+    scan_thread.start()
+    conf.OnReload(lambda conf, changed: RetuneScan(scan_thread.scan))
+    if role == 'owner-set':
+        config_thread = config_app.ConfigThread(Accessories, conf.select_window,
+                                                conf.select_poll,
+                                                conf.provision_bulk)
+        config_thread.start()
+    try:
+        await pipe.run(stream)
+    finally:
+        scan_thread.stop()
+        if role == 'owner-set':
+            config_thread.stop()
+        logger.info('Stream stats: {}'.format(stream.Stats()))
+        logger.info('Pipeline stats: {}'.format(pipe.Stats()))
+        LogStats()
+
+
+if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--role', type=str,
                         choices=['scanner', 'owner-set', 'owner-find'],
@@ -161,7 +390,58 @@ if __name__ == '__main__':
     parser.add_argument('--server', type=str,
                         choices=['on', 'off'],
                         default='off')
+    parser.add_argument('--profile', type=str, default=None,
+                        choices=sorted(settings.PROFILES))
+    parser.add_argument('--config', type=str, default=None,
+                        help='JSON settings file, reloaded on SIGHUP')
+    parser.add_argument('--set', type=str, action='append', default=[],
+                        metavar='NAME=VALUE', help='override one setting')
+    parser.add_argument('--pipeline', type=str,
+                        choices=['thread', 'asyncio'],
+                        default=None)
+    parser.add_argument('--encrypt-workers', type=int, default=None,
+                        help='encrypt in a worker pool of this size (0: inline)')
+    parser.add_argument('--encrypt-pool', type=str,
+                        choices=['thread', 'process'],
+                        default=None)
+    parser.add_argument('--decrypt-workers', type=int, default=None,
+                        help='owner-find decrypt processes (default: all cores)')
+    parser.add_argument('--keyring', type=str, default=None,
+                        help='owner-find every tag in this key store directory')
+    parser.add_argument('--record', type=str, default=None,
+                        help='record received adverts to this file for replay.py')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on this port')
+    parser.add_argument('--metrics-dump', type=float, default=None,
+                        help='log all metrics every this many seconds')
+    parser.add_argument('--log-level', type=str, default='DEBUG',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-file', type=str, default=None,
+                        help='log through a queue to this rotating file')
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help='log one in N per-advertisement debug messages')
     args = parser.parse_args()
+    logger_config.init_logger(args.log_level, args.log_file,
+                              sample_every=args.log_sample)
+    try:
+        overrides = dict(settings.ParseOverride(s) for s in args.set)
+        for name in ('pipeline', 'encrypt_workers', 'encrypt_pool'):
+            if getattr(args, name) is not None:
+                overrides[name] = getattr(args, name)
+        conf = settings.Settings(args.profile, args.config, overrides)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    logger.info('Settings ({}): {}'.format(args.profile or 'default',
+                                           conf.values))
+    ApplySettings(conf)
+    conf.OnReload(ApplySettings)
+    # reload off the signal handler so it never runs inside a logging call
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=conf.Reload, name='Reload').start())
+    if args.metrics_port is not None:
+        metrics.Serve(args.metrics_port)
+    if args.metrics_dump:
+        metrics.DumpEvery(args.metrics_dump)
     role = args.role
     global server_on
     if args.server == 'on':
@@ -181,23 +461,76 @@ if __name__ == '__main__':
         if not server_on:
             logger.error('please config server on')
             exit()
+        if args.keyring:
+            QueryFleet(keystore.KeyStore(args.keyring), args.decrypt_workers)
+            exit()
         pubkey_bytes, e = key_management.ExtractPubKey()
-        QueryAccessoryInfo(pubkey_bytes)
+        QueryAccessoryInfo(pubkey_bytes, args.decrypt_workers)
         exit()
-    message_queue = queue.Queue(maxsize=100)
-    scan_thread = scan.ScanProc(message_queue)
+    # the scanning roles need BlueZ (dbus-python, PyGObject); the rest of
+    # this module also serves replay.py and the benchmarks without them
+    import config_app
+    import scan
+    global upload_proc
+    if role == 'owner-set' and server_on:
+        RegisterOwnerKey()
+    upload_proc = uploader.UploadProc(conf.Url(uploader.REGISTER_PATH),
+                                      conf.upload_batch, conf.upload_interval,
+                                      conf.upload_timeout)
+    upload_proc.start()
+    conf.OnReload(RetuneUpload)
+    recorder = None
+    if args.record:
+        recorder = advert_log.AdvertRecorder(args.record)
+    encrypt_pool = None
+    if conf.encrypt_workers > 0:
+        encrypt_pool = encryptor.EncryptPool(conf.encrypt_pool,
+                                             conf.encrypt_workers)
+    if conf.pipeline == 'asyncio':
+        try:
+            asyncio.run(RunAsyncScanner(role, encrypt_pool, recorder))
+        except KeyboardInterrupt:
+            pass
+        if encrypt_pool is not None:
+            encrypt_pool.shutdown()
+            logger.info('Encrypt stats: {}'.format(encrypt_pool.Stats()))
+        if recorder is not None:
+            recorder.close()
+        upload_proc.stop()
+        exit()
+    if encrypt_pool is not None:
+        encrypt_pool.on_done = Upload
+        report_sink = encrypt_pool.Submit
+    message_queue = consumer.MessageQueue(maxsize=conf.queue_size)
+    StartKeyDirectory(message_queue)
+    scan_thread = scan.ScanProc(message_queue, recorder, **ScanOptions())
     scan_thread.start()
+    conf.OnReload(lambda conf, changed: RetuneScan(scan_thread.scan))
     if role == 'owner-set':
-        config_thread = config_app.ConfigThread(Accessories)
+        config_thread = config_app.ConfigThread(Accessories, conf.select_window,
+                                                conf.select_poll,
+                                                conf.provision_bulk)
         config_thread.start()
+    msg_consumer = consumer.MessageConsumer(message_queue, GotMessage,
+                                            conf.consumer_batch,
+                                            conf.stats_interval)
+
+    def RetuneConsumer(conf, changed):
+        msg_consumer.batch_size = conf.consumer_batch
+        msg_consumer.report_interval = conf.stats_interval
+    conf.OnReload(RetuneConsumer)
     try:
-        while True:
-            try:
-                msg = message_queue.get(block=False)
-                GotMessage(msg)
-            except queue.Empty:
-                time.sleep(8)
+        msg_consumer.run()
     except KeyboardInterrupt:
+        msg_consumer.stop()
+        logger.info('Queue stats: {}'.format(msg_consumer.Stats()))
+        LogStats()
         scan_thread.stop()
         if role == 'owner-set':
             config_thread.stop()
+        if encrypt_pool is not None:
+            encrypt_pool.shutdown()
+            logger.info('Encrypt stats: {}'.format(encrypt_pool.Stats()))
+        if recorder is not None:
+            recorder.close()
+        upload_proc.stop()
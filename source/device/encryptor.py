@@ -0,0 +1,161 @@
+import base64
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import threading
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import metrics
+
+logger = logging.getLogger('BLELogger')
+
+ENCRYPTIONS = metrics.REGISTRY.Counter(
+    'ble_encryptions_total', 'Location reports encrypted')
+ENCRYPT_SECONDS = metrics.REGISTRY.Histogram(
+    'ble_encrypt_seconds', 'Time to form the key and encrypt one report')
+
+
+def FormKey(key_bytes):
+    e = 65537
+    n = int.from_bytes(key_bytes, 'little')
+    key_num = rsa.RSAPublicNumbers(e=e, n=n)
+    pub_key = key_num.public_key(backend=default_backend())
+    return pub_key
+
+
+class KeyCache():
+    # LRU of public key objects keyed by the raw 64-byte modulus,
+    # shared by all accessories so repeat sightings skip FormKey
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.keys = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hit_num = 0
+        self.miss_num = 0
+
+    def Get(self, key_bytes):
+        with self.lock:
+            pub_key = self.keys.get(key_bytes)
+            if pub_key is not None:
+                self.keys.move_to_end(key_bytes)
+                self.hit_num += 1
+                return pub_key
+            self.miss_num += 1
+        pub_key = FormKey(key_bytes)
+        with self.lock:
+            self.keys[key_bytes] = pub_key
+            if len(self.keys) > self.capacity:
+                self.keys.popitem(last=False)
+        return pub_key
+
+    def Stats(self):
+        return {
+            'size': len(self.keys),
+            'hit': self.hit_num,
+            'miss': self.miss_num,
+        }
+
+
+key_cache = KeyCache()
+
+
+def MakeReport(pubkey_bytes, location):
+    start = metrics.Start()
+    pubKey = key_cache.Get(pubkey_bytes)
+    # encrypted = base64.b64encode(pubKey.encrypt(location,padding.PKCS1v15()))
+    encrypted = pubKey.encrypt(location, padding.PKCS1v15())
+    for_upload = {
+        'key': base64.b64encode(pubkey_bytes).decode('utf-8'),
+        'content': base64.b64encode(encrypted).decode('utf-8')
+    }
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('\nkey:%s,content:%s', pubkey_bytes.hex(), encrypted.hex())
+    ENCRYPTIONS.Inc()
+    ENCRYPT_SECONDS.ObserveSince(start)
+    return for_upload
+
+
+def TimedReport(pubkey_bytes, location):
+    # worker entry point: returns the report and the seconds spent encrypting
+    start = time.perf_counter()
+    report = MakeReport(pubkey_bytes, location)
+    return report, time.perf_counter() - start
+
+
+class EncryptPool():
+    # Optional worker pool for MakeReport so the message loop never waits on
+    # RSA. kind='process' scales with cores; each worker process keeps its
+    # own key_cache. on_done(report) runs on the pool's callback thread.
+    def __init__(self, kind='thread', size=None, on_done=None):
+        if kind == 'process':
+            # workers start from a clean server process: forking here would
+            # copy the D-Bus, upload and metrics threads' locks mid-use
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                size, mp_context=multiprocessing.get_context('forkserver'))
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                size, thread_name_prefix='Encrypt')
+        self.kind = kind
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.submitted_num = 0
+        self.done_num = 0
+        self.failed_num = 0
+        self.encrypt_time = 0.0
+        self.total_time = 0.0
+        self.max_total_time = 0.0
+
+    def Submit(self, pubkey_bytes, location):
+        start = time.perf_counter()
+        future = self.executor.submit(TimedReport, pubkey_bytes, location)
+        with self.lock:
+            self.submitted_num += 1
+        future.add_done_callback(lambda f: self._Done(f, start))
+        return future
+
+    def Result(self, future, timeout=None):
+        report, _ = future.result(timeout=timeout)
+        return report
+
+    def _Done(self, future, start):
+        total = time.perf_counter() - start
+        try:
+            report, spent = future.result()
+        except Exception as e:
+            with self.lock:
+                self.failed_num += 1
+            logger.error('encrypt failed: {}'.format(e))
+            return
+        with self.lock:
+            self.done_num += 1
+            self.encrypt_time += spent
+            self.total_time += total
+            self.max_total_time = max(self.max_total_time, total)
+        if self.kind == 'process':
+            # worker processes have their own metrics; count them here
+            ENCRYPTIONS.Inc()
+            ENCRYPT_SECONDS.Observe(spent)
+        if self.on_done is not None:
+            self.on_done(report)
+
+    def Stats(self):
+        with self.lock:
+            done = max(self.done_num, 1)
+            return {
+                'kind': self.kind,
+                'submitted': self.submitted_num,
+                'done': self.done_num,
+                'failed': self.failed_num,
+                'pending': self.submitted_num - self.done_num - self.failed_num,
+                'encrypt_ms_avg': 1000 * self.encrypt_time / done,
+                'wait_ms_avg': 1000 * (self.total_time - self.encrypt_time) / done,
+                'total_ms_max': 1000 * self.max_total_time,
+            }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
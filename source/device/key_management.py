@@ -11,7 +11,7 @@ AccessoryKeyPath = '../Accessory/AccessoryKey'
 # AccessoryKeyPath = 'AccessoryKey'
 
 
-def GenKeyPair():
+def GenKeyPair(pri_path=None, pub_path=None):
     key_pair = rsa.generate_private_key(public_exponent=65537,
                                           key_size=512,
                                           backend=default_backend())
@@ -21,38 +21,49 @@ def GenKeyPair():
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.PKCS8,
         encryption_algorithm=serialization.NoEncryption())
-    with open(PriKeyPath, 'wb') as f:
+    with open(pri_path or PriKeyPath, 'wb') as f:
         f.write(private_pem)
         f.close()
 
     public_pem = public_key.public_bytes(
         encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.Subjectpublic_keyInfo
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
         # 	format=serialization.PublicFormat.PKCS1
     )
-    with open(PubKeyPath, 'wb') as f:
+    with open(pub_path or PubKeyPath, 'wb') as f:
         f.write(public_pem)
         f.close()
 
 
-def LoadPubKey():
-    with open(PubKeyPath, "rb") as f:
+def LoadPubKey(path=None):
+    with open(path or PubKeyPath, "rb") as f:
         public_key = serialization.load_pem_public_key(
             f.read(), backend=default_backend())
         f.close()
     return public_key
 
 
-def LoadPriKey():
-    with open(PriKeyPath, "rb") as f:
+def LoadPriKey(path=None):
+    with open(path or PriKeyPath, "rb") as f:
         private_key = serialization.load_pem_private_key(
             f.read(), password=None, backend=default_backend())
         f.close()
     return private_key
 
 
-def ExtractPubKey():
-    pub_key = LoadPubKey()
+_pri_keys = {}
+
+
+def CachedPriKey(path=None):
+    # load and parse each PEM once per process
+    path = path or PriKeyPath
+    if path not in _pri_keys:
+        _pri_keys[path] = LoadPriKey(path)
+    return _pri_keys[path]
+
+
+def ExtractPubKey(path=None):
+    pub_key = LoadPubKey(path)
     raw_key = pub_key.public_numbers()
     raw_key_n = raw_key.n
     raw_key_e = raw_key.e
@@ -0,0 +1,142 @@
+import base64
+import collections
+import logging
+import threading
+import time
+
+import requests
+
+import metrics
+from beacon_format import KeyId
+
+logger = logging.getLogger('BLELogger')
+
+KEYS_PATH = '/ble/keys'
+
+LOOKUPS = metrics.REGISTRY.Counter(
+    'ble_keydir_lookups_total', 'Compact beacon key ids looked up')
+FETCHED = metrics.REGISTRY.Counter(
+    'ble_keydir_fetched_total', 'Key ids resolved by the server directory')
+
+
+def RegisterKey(url, pub_key, timeout=10):
+    # owner side: publish the public key so scanners can resolve its id
+    r = requests.post(url, json={
+        'key': base64.b64encode(pub_key).decode('utf-8')}, timeout=timeout)
+    if r.status_code != 200 or r.json().get('code', -1) != 0:
+        raise requests.RequestException('register failed: {}'.format(r.text))
+    return bytes.fromhex(r.json()['id'])
+
+
+class KeyDirectory(threading.Thread):
+    # Resolves compact beacon key ids to public keys. Known ids answer from
+    # an in-memory LRU; unknown ones are batched into one server request per
+    # flush_interval, and each resolved key is handed to
+    # resolved(addr, time, key) from this thread. Ids the server does not
+    # know are not asked for again for miss_ttl seconds.
+    def __init__(self, url, resolved, capacity=4096, miss_ttl=300,
+                 flush_interval=1.0, timeout=10):
+        self.url = url
+        self.resolved = resolved
+        self.capacity = capacity
+        self.miss_ttl = miss_ttl
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        # key_id -> key, or None until the miss expires
+        self.known = collections.OrderedDict()
+        self.missing = {}
+        # key_id -> (addr, time) of the latest sighting waiting on it
+        self.pending = {}
+        self.cond = threading.Condition()
+        self._stop = False
+        self.hit_num = 0
+        self.fetched_num = 0
+        self.unknown_num = 0
+        super().__init__(daemon=True, name='KeyDirectory')
+
+    def Lookup(self, key_id, addr, when):
+        # the key if known now, else None (resolved later if the server has it)
+        LOOKUPS.Inc()
+        with self.cond:
+            key = self.known.get(key_id)
+            if key is not None:
+                self.known.move_to_end(key_id)
+                self.hit_num += 1
+                return key
+            if self.missing.get(key_id, 0) > time.monotonic():
+                return None
+            self.pending[key_id] = (addr, when)
+            self.cond.notify()
+        return None
+
+    def _Fetch(self, key_ids):
+        r = self.session.post(self.url, json={
+            'ids': [i.hex() for i in key_ids]}, timeout=self.timeout)
+        if r.status_code != 200 or r.json().get('code', -1) != 0:
+            raise requests.RequestException('lookup failed: {}'.format(r.text))
+        keys = {}
+        for key_id, key in r.json().get('keys', {}).items():
+            key_id = bytes.fromhex(key_id)
+            key = base64.b64decode(key)
+            # never trust the directory for a key that does not hash to its id
+            if KeyId(key) == key_id:
+                keys[key_id] = key
+        return keys
+
+    def Flush(self):
+        with self.cond:
+            pending = self.pending
+            self.pending = {}
+        if not pending:
+            return
+        try:
+            keys = self._Fetch(list(pending))
+        except (requests.RequestException, ValueError) as e:
+            logger.info('key directory lookup failed. {}'.format(e))
+            # retry with the next sightings
+            return
+        expiry = time.monotonic() + self.miss_ttl
+        with self.cond:
+            for key_id in pending:
+                key = keys.get(key_id)
+                if key is None:
+                    self.missing[key_id] = expiry
+                    self.unknown_num += 1
+                    continue
+                self.missing.pop(key_id, None)
+                self.known[key_id] = key
+                self.known.move_to_end(key_id)
+            while len(self.known) > self.capacity:
+                self.known.popitem(last=False)
+            if len(self.missing) > self.capacity:
+                now = time.monotonic()
+                self.missing = {i: t for i, t in self.missing.items() if t > now}
+        self.fetched_num += len(keys)
+        FETCHED.Inc(len(keys))
+        for key_id, key in keys.items():
+            addr, when = pending[key_id]
+            self.resolved(addr, when, key)
+
+    def run(self):
+        while not self._stop:
+            with self.cond:
+                if not self.pending:
+                    self.cond.wait(timeout=self.flush_interval)
+            if self.pending:
+                # let a burst of new ids collect into one request
+                time.sleep(self.flush_interval)
+            self.Flush()
+
+    def Stats(self):
+        return {
+            'known': len(self.known),
+            'hit': self.hit_num,
+            'fetched': self.fetched_num,
+            'unknown': self.unknown_num,
+        }
+
+    def stop(self):
+        with self.cond:
+            self._stop = True
+            self.cond.notify()
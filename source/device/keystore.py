@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import shutil
+
+import key_management
+
+KeyStorePath = 'keys'
+
+
+# Labelled key pairs for a fleet of tags: <path>/<label>.pem/.pub.pem plus
+# index.json mapping label -> public key bytes (hex) for lookups either way.
+class KeyStore():
+    def __init__(self, path=KeyStorePath):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+                f.close()
+        self.by_key = {v: k for k, v in self.index.items()}
+
+    def _Save(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+            f.close()
+        os.replace(tmp, self.index_path)
+
+    def PriKeyPath(self, label):
+        return os.path.join(self.path, label + '.pem')
+
+    def PubKeyPath(self, label):
+        return os.path.join(self.path, label + '.pub.pem')
+
+    def _Register(self, label):
+        key_bytes, e = key_management.ExtractPubKey(self.PubKeyPath(label))
+        self.index[label] = key_bytes.hex()
+        self.by_key[key_bytes.hex()] = label
+        self._Save()
+        return key_bytes
+
+    def Generate(self, label):
+        assert label not in self.index, "label exists:{}".format(label)
+        os.makedirs(self.path, exist_ok=True)
+        key_management.GenKeyPair(self.PriKeyPath(label), self.PubKeyPath(label))
+        return self._Register(label)
+
+    def Import(self, label, pri_path, pub_path):
+        assert label not in self.index, "label exists:{}".format(label)
+        os.makedirs(self.path, exist_ok=True)
+        shutil.copyfile(pri_path, self.PriKeyPath(label))
+        shutil.copyfile(pub_path, self.PubKeyPath(label))
+        return self._Register(label)
+
+    def Labels(self):
+        return sorted(self.index)
+
+    def PubKey(self, label):
+        return bytes.fromhex(self.index[label])
+
+    def Find(self, key_bytes):
+        return self.by_key.get(key_bytes.hex())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['list', 'add', 'import'])
+    parser.add_argument('label', nargs='?')
+    parser.add_argument('--path', type=str, default=KeyStorePath)
+    args = parser.parse_args()
+    store = KeyStore(args.path)
+    if args.action == 'add':
+        store.Generate(args.label)
+    elif args.action == 'import':
+        # adopt the single-tag priKey.pem/pubKey.pem pair
+        store.Import(args.label, key_management.PriKeyPath,
+                     key_management.PubKeyPath)
+    for label in store.Labels():
+        print('{}: {}'.format(label, store.index[label]))
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger('BLELogger')
+
+# Metrics are off unless Enable() is called; while off every update is a
+# flag check and Start() skips the clock read. Updates are not locked, so
+# counts may be off by a few under heavy thread contention.
+ENABLED = False
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+def Enable():
+    global ENABLED
+    ENABLED = True
+
+
+def Start():
+    return time.perf_counter() if ENABLED else 0.0
+
+
+class Counter():
+    __slots__ = ('name', 'help', 'value')
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def Inc(self, n=1):
+        if ENABLED:
+            self.value += n
+
+    def Render(self):
+        return ['{} {}'.format(self.name, self.value)]
+
+
+class Gauge():
+    # fn, when given, is called at render time (e.g. a queue's qsize)
+    __slots__ = ('name', 'help', 'value', 'fn')
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+
+    def Set(self, value):
+        if ENABLED:
+            self.value = value
+
+    def Render(self):
+        value = self.fn() if self.fn is not None else self.value
+        return ['{} {}'.format(self.name, value)]
+
+
+class Histogram():
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def Observe(self, value):
+        if not ENABLED:
+            return
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def ObserveSince(self, start):
+        if ENABLED:
+            self.Observe(time.perf_counter() - start)
+
+    def Render(self):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound,
+                                                          cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+        lines.append('{}_sum {}'.format(self.name, self.sum))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+
+    def _Add(self, metric):
+        # the same name returns the existing metric, so modules can declare
+        # their metrics independently
+        return self.metrics.setdefault(metric.name, metric)
+
+    def Counter(self, name, help):
+        return self._Add(Counter(name, help))
+
+    def Gauge(self, name, help, fn=None):
+        gauge = self._Add(Gauge(name, help))
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def Histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._Add(Histogram(name, help, buckets))
+
+    def Render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.Render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsRequest(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.Render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def Serve(port, host=''):
+    # /metrics endpoint on its own daemon thread
+    Enable()
+    httpd = ThreadingHTTPServer((host, port), MetricsRequest)
+    threading.Thread(target=httpd.serve_forever, daemon=True,
+                     name='Metrics').start()
+    logger.info('metrics at http://{}:{}/metrics'.format(host or 'localhost',
+                                                         port))
+    return httpd
+
+
+def DumpEvery(interval):
+    # periodic dump to the log for hosts without a scraper
+    Enable()
+
+    def dump():
+        while True:
+            time.sleep(interval)
+            logger.info('metrics:\n{}'.format(REGISTRY.Render()))
+    threading.Thread(target=dump, daemon=True, name='MetricsDump').start()
@@ -0,0 +1,51 @@
+import base64
+import json
+import os
+
+OwnerCachePath = 'owner_cache.json'
+
+
+# Decrypted owner-find results per public key, with the server cursor (or
+# last timestamp) to resume from, so repeat runs only fetch new reports.
+class ResultCache():
+    def __init__(self, path=OwnerCachePath):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+                f.close()
+
+    def _Entry(self, pub_key):
+        return self.entries.setdefault(pub_key.hex(), {
+            'cursor': None,
+            'last_timestamp': None,
+            'results': []
+        })
+
+    def Resume(self, pub_key):
+        entry = self._Entry(pub_key)
+        return entry['cursor'], entry['last_timestamp']
+
+    def Append(self, pub_key, timestamp, decrypted):
+        entry = self._Entry(pub_key)
+        entry['results'].append({
+            'timestamp': timestamp,
+            'location': base64.b64encode(decrypted).decode('utf-8')
+        })
+        if entry['last_timestamp'] is None or timestamp > entry['last_timestamp']:
+            entry['last_timestamp'] = timestamp
+
+    def SetCursor(self, pub_key, cursor):
+        self._Entry(pub_key)['cursor'] = cursor
+
+    def Results(self, pub_key):
+        return [(r['timestamp'], base64.b64decode(r['location']))
+                for r in self._Entry(pub_key)['results']]
+
+    def Save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+            f.close()
+        os.replace(tmp, self.path)
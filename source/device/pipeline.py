@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+logger = logging.getLogger('BLELogger')
+
+
+class AsyncPipeline():
+    # Runs the scanner stages on one asyncio loop:
+    #   stream -> handler (reassembly, inline) -> encrypt (bounded) -> upload
+    # handler is GotMessage; completed keys reach Submit through report_sink.
+    # Encryption runs on pool (an encryptor.EncryptPool) when given, else on
+    # the loop's default executor.
+    def __init__(self, handler, encrypt, upload, concurrency=4, pool=None):
+        self.handler = handler
+        self.encrypt = encrypt
+        self.upload = upload
+        self.concurrency = concurrency
+        self.pool = pool
+        self.loop = None
+        self.sem = None
+        self.tasks = set()
+        self.handled_num = 0
+        self.encrypted_num = 0
+        self.failed_num = 0
+
+    def Submit(self, key_bytes, location):
+        task = self.loop.create_task(self._Encrypt(key_bytes, location))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _Encrypt(self, key_bytes, location):
+        async with self.sem:
+            try:
+                if self.pool is not None:
+                    future = self.pool.Submit(key_bytes, location)
+                    await asyncio.wrap_future(future)
+                    report = self.pool.Result(future)
+                else:
+                    report = await self.loop.run_in_executor(
+                        None, self.encrypt, key_bytes, location)
+            except Exception:
+                self.failed_num += 1
+                logger.exception('encrypt failed for key:{}'.format(
+                    key_bytes.hex()))
+                return
+        self.encrypted_num += 1
+        self.upload(report)
+
+    async def run(self, stream):
+        self.loop = asyncio.get_running_loop()
+        self.sem = asyncio.Semaphore(self.concurrency)
+        try:
+            async for sighting in stream:
+                try:
+                    self.handler(sighting)
+                except Exception:
+                    logger.exception('failed to handle msg:{}'.format(sighting))
+                self.handled_num += 1
+        finally:
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def Stats(self):
+        return {
+            'handled': self.handled_num,
+            'encrypting': len(self.tasks),
+            'encrypted': self.encrypted_num,
+            'failed': self.failed_num,
+        }
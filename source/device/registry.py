@@ -0,0 +1,57 @@
+import collections
+import datetime
+import threading
+
+
+# Accessories keyed by address, kept in last_seen order (oldest first) so
+# lookup, insert and eviction of stale entries are all O(1).
+class AccessoryRegistry():
+    def __init__(self, max_age=datetime.timedelta(days=1)):
+        self.max_age = max_age
+        self._accs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._accs)
+
+    def __contains__(self, addr):
+        return addr in self._accs
+
+    def Get(self, addr):
+        return self._accs.get(addr)
+
+    def Add(self, acc):
+        with self._lock:
+            self._accs[acc.addr] = acc
+            self._accs.move_to_end(acc.addr)
+
+    def Touch(self, acc, when):
+        with self._lock:
+            acc.last_seen = when
+            self._accs.move_to_end(acc.addr)
+
+    def Evict(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        evicted = 0
+        with self._lock:
+            while self._accs:
+                acc = next(iter(self._accs.values()))
+                if acc.last_seen is not None and \
+                        (now - acc.last_seen) <= self.max_age:
+                    break
+                self._accs.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def Recent(self, within, now=None):
+        # newest first, stops at the first entry older than `within`
+        if now is None:
+            now = datetime.datetime.now()
+        recent = []
+        with self._lock:
+            for acc in reversed(self._accs.values()):
+                if acc.last_seen is None or (now - acc.last_seen) > within:
+                    break
+                recent.append(acc)
+        return recent
@@ -0,0 +1,155 @@
+import argparse
+import datetime
+import json
+import logging
+import resource
+import time
+import tracemalloc
+
+import advert_filter
+import advert_log
+import device
+import uploader
+
+logger = logging.getLogger('BLELogger')
+
+
+class StageTimer():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def Add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def Stats(self):
+        return {
+            'count': self.count,
+            'avg_us': 1e6 * self.total / max(self.count, 1),
+            'max_us': 1e6 * self.max,
+        }
+
+
+class ReplaySink():
+    # stands in for the message queue and the uploader: runs GotMessage
+    # inline and keeps reports in memory, timing each stage
+    def __init__(self, upload_proc=None):
+        self.upload_proc = upload_proc
+        self.reports = 0
+        self.handle = StageTimer()
+        self.encrypt = StageTimer()
+        self.upload = StageTimer()
+        self.encrypt_time = 0.0
+
+    def put(self, msg, block=True):
+        before = self.encrypt_time
+        start = time.perf_counter()
+        device.GotMessage(msg)
+        # reassembly only: encryption that GotMessage triggered is timed apart
+        self.handle.Add(time.perf_counter() - start
+                        - (self.encrypt_time - before))
+
+    def Report(self, pubkey_bytes, location):
+        start = time.perf_counter()
+        report = device.encryptor.MakeReport(pubkey_bytes, location)
+        spent = time.perf_counter() - start
+        self.encrypt.Add(spent)
+        start = time.perf_counter()
+        self.Add(report)
+        spent += time.perf_counter() - start
+        self.encrypt_time += spent
+
+    def Add(self, report):
+        start = time.perf_counter()
+        self.reports += 1
+        if self.upload_proc is not None:
+            self.upload_proc.Add(report)
+        self.upload.Add(time.perf_counter() - start)
+
+
+def Replay(adverts, realtime=False, upload_url=None, trace_memory=False):
+    # push (t, address, payload) through AdvertFilter -> GotMessage ->
+    # UploadAcc at full speed (or at recorded pace with realtime)
+    upload_proc = None
+    if upload_url:
+        upload_proc = uploader.UploadProc(upload_url, spool_path='replay_spool')
+        upload_proc.start()
+    sink = ReplaySink(upload_proc)
+    device.report_sink = sink.Report
+    filt = advert_filter.AdvertFilter(sink)
+    parse = StageTimer()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    adverts_num = 0
+    for t, address, payload in adverts:
+        if realtime:
+            delay = t - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        properties = {'Address': address,
+                      'ManufacturerData': advert_log.ManufacturerData(payload)}
+        before = sink.handle.total + sink.encrypt_time
+        t0 = time.perf_counter()
+        filt.FilterData('/replay/' + address, properties)
+        parse.Add(time.perf_counter() - t0
+                  - (sink.handle.total + sink.encrypt_time - before))
+        adverts_num += 1
+    elapsed = time.perf_counter() - start
+    if upload_proc is not None:
+        upload_proc.stop()
+    result = {
+        'adverts': adverts_num,
+        'seconds': elapsed,
+        'adverts_per_sec': adverts_num / elapsed if elapsed else 0,
+        'reports': sink.reports,
+        'stages': {
+            'filter': parse.Stats(),
+            'reassemble': sink.handle.Stats(),
+            'encrypt': sink.encrypt.Stats(),
+            'upload': sink.upload.Stats(),
+        },
+        'scan': filt.Stats(),
+        'sightings': device.sightings.Stats(),
+        'key_cache': device.encryptor.key_cache.Stats(),
+        'accessories': len(device.Accessories),
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['traced_kb'] = {'current': current // 1024, 'peak': peak // 1024}
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default=None,
+                        help='recorded advert log; synthetic tags if omitted')
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--hz', type=float, default=1.0)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--realtime', action='store_true')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='encrypt every completed key, not once per window')
+    parser.add_argument('--upload-url', type=str, default=None,
+                        help='also upload reports, e.g. to a local server.py')
+    parser.add_argument('--trace-memory', action='store_true')
+    parser.add_argument('--extended', action='store_true',
+                        help='synthetic tags send the whole key in one advert')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.no_dedup:
+        device.sightings.window = datetime.timedelta(0)
+    if args.input:
+        adverts = advert_log.ReadAdverts(args.input)
+    else:
+        adverts = advert_log.SynthAdverts(args.tags, args.hz, args.duration,
+                                          args.seed, args.extended)
+    print(json.dumps(Replay(adverts, args.realtime, args.upload_url,
+                            args.trace_memory), indent=2))
@@ -1,5 +1,5 @@
 #!/usr/bin/python
-import datetime
+import asyncio
 import logging
 import threading
 
@@ -7,6 +7,7 @@ import dbus
 import dbus.mainloop.glib
 from gi.repository import GObject
 
+from advert_filter import AdvertFilter
 from ble_helper import (
     BLUEZ_SERVICE_NAME,
     DBUS_OM_IFACE,
@@ -17,22 +18,77 @@ from ble_helper import (
     UUID_CONFIGSERVICE_WHOLE,
     FindAdapterPath,
 )
+import metrics
 
 logger = logging.getLogger('BLELogger')
 
-class ScanCtrl():
 
-    def __init__(self, mainloop, bus, message):
+class SightingStream():
+    # Thread-safe handoff from the GLib/D-Bus thread into an asyncio loop.
+    # put() never blocks the D-Bus thread: when the stream is full the
+    # sighting is dropped and counted instead.
+    def __init__(self, loop, maxsize=100):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.put_num = 0
+        self.dropped_num = 0
+        self.closed = False
+        metrics.REGISTRY.Gauge('ble_queue_depth',
+                               'Messages waiting for the consumer',
+                               fn=self.qsize)
+
+    def put(self, item, block=True):
+        self.loop.call_soon_threadsafe(self._Offer, item)
+
+    def _Offer(self, item):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(item)
+            self.put_num += 1
+        except asyncio.QueueFull:
+            self.dropped_num += 1
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._Close)
+
+    def _Close(self):
+        self.closed = True
+        # wait for room rather than dropping the end-of-stream marker
+        self.loop.create_task(self.queue.put(None))
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    def Stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'put': self.put_num,
+            'dropped': self.dropped_num,
+        }
+
+
+class ScanCtrl(AdvertFilter):
+
+    def __init__(self, mainloop, bus, message, max_devices=1024,
+                 max_age=600, refresh=30, recorder=None, duplicate_data=False):
+        super().__init__(message, max_devices, max_age, refresh, recorder)
         self.mainloop = mainloop
-        self.message = message
         adapter_path = FindAdapterPath(bus, [ADAPTER_INTERFACE])
         self.adapter = dbus.Interface(
             bus.get_object(BLUEZ_SERVICE_NAME, adapter_path), ADAPTER_INTERFACE)
         # adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
         #                            DBUS_PROP_IFACE)
         # adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
-        self.received_num = 0
-        self.devices = {}
         self.registered = False
 
         bus.add_signal_receiver(self.InterfaceAdded,
@@ -50,11 +106,11 @@ class ScanCtrl():
         objects = manager.GetManagedObjects()
         for path, interfaces in objects.items():
             if DEVICE_INTERFACE in interfaces.keys():
-                self.devices[path] = interfaces[DEVICE_INTERFACE]
+                self.UpdateDevice(path, interfaces[DEVICE_INTERFACE])
 
         self.adapter.SetDiscoveryFilter({
             'DuplicateData':
-            False,
+            duplicate_data,
             'Transport':
             'le',
             'UUIDs': [UUID_BEACONSERVICE_WHOLE, UUID_CONFIGSERVICE_WHOLE]
@@ -69,63 +125,14 @@ class ScanCtrl():
             logger.warning('properties empty!')
             return
 
-        if path in self.devices:
-            self.devices[path].update(properties)
-        else:
-            self.devices[path] = properties
-
-        if "Address" in self.devices[path]:
-            address = properties["Address"]
-        else:
-            address = "<unknown>"
-        self.RevealData(address, path)
+        self.FilterData(path, properties)
 
     def PropertiesChanged(self, interface, changed, invalidated, path):
         if interface != "org.bluez.Device1":
             logger.warning('Interface missed')
             return
-        if path in self.devices:
-            self.devices[path].update(changed)
-        else:
-            self.devices[path] = changed
-
-        if "Address" in self.devices[path]:
-            address = self.devices[path]["Address"]
-        else:
-            address = "<unknown>"
-        self.RevealData(address, path)
-
-    def RevealData(self, address, path):
-        self.received_num += 1
-        logger.debug("\n***{} : {} *** [ ".format(
-                datetime.datetime.now().strftime("%H:%M:%S"), self.received_num)
-            + address + " ]")
-        properties = self.devices[path]
-        content = properties['ManufacturerData']
-        for k, v in content.items():
-            logger.debug("manufacture_ID:{}".format(hex(k)))
-            assert k == int(0x6b5a), "wrong manufacture_ID:{}".format(k)
-            index = int(v[0])
-            logger.debug("Index:{}".format(index))
-            if (index == 255):
-                self.message.put(
-                    {
-                        'type': 'config',
-                        'addr': address,
-                        'time': datetime.datetime.now()
-                    },
-                    block=True)
-            else:
-                self.message.put(
-                    {
-                        'type': 'beacon',
-                        'addr': address,
-                        'time': datetime.datetime.now(),
-                        'index': int(v[0]),
-                        'data': [bytes([d]) for d in v[1:23]]
-                    },
-                    block=True)
-        
+        self.FilterData(path, changed)
+
     def start(self):
         if self.registered:
             print("ScanCtrl already started!")
@@ -148,10 +155,13 @@ class ScanCtrl():
 
 
 class ScanProc(threading.Thread):
-    def __init__(self, message):
+    def __init__(self, message, recorder=None, **options):
+        # options: ScanCtrl keyword arguments (max_devices, refresh, ...)
         self.mainloop = None
         self.scan = None
         self.message = message
+        self.recorder = recorder
+        self.options = options
         super().__init__()
 
     def run(self):
@@ -159,12 +169,14 @@ class ScanProc(threading.Thread):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         bus = dbus.SystemBus()
         self.mainloop = GObject.MainLoop()
-        self.scan = ScanCtrl(self.mainloop, bus, self.message)
+        self.scan = ScanCtrl(self.mainloop, bus, self.message,
+                             recorder=self.recorder, **self.options)
         self.scan.start()
         self.mainloop.run()
 
     def stop(self):
         logger.info('Byebye ScanProc!')
+        logger.info('Scan stats: {}'.format(self.scan.Stats()))
         self.scan.stop()
         self.mainloop.quit()
 
@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger('BLELogger')
+
+ENV_PREFIX = 'BLE_'
+
+# every tunable with its default; the default's type is the setting's type
+DEFAULTS = {
+    'server': 'https://bletracker.supportvector.com',
+    'pipeline': 'thread',
+    'queue_size': 100,
+    'consumer_batch': 32,
+    'stats_interval': 60,
+    # seconds between beacons after which a half-collected key is discarded
+    'reset_window': 120,
+    'accessory_max_age': 24 * 3600,
+    # owner-set: how recent a config-mode tag must be, and how often to look
+    'select_window': 60,
+    'select_poll': 5.0,
+    # owner-set: send the key in one bulk GATT write, falling back to
+    # 16 byte writes for accessories without it
+    'provision_bulk': True,
+    'duplicate_data': False,
+    'scan_refresh': 30,
+    'scan_max_devices': 1024,
+    'scan_max_age': 600,
+    'report_window': 600,
+    'report_min_distance': 100.0,
+    'upload_batch': 50,
+    'upload_interval': 60.0,
+    'upload_timeout': 10.0,
+    'encrypt_workers': 0,
+    'encrypt_pool': 'thread',
+    # compact beacon key ids: directory LRU size, and how long to wait
+    # before asking the server again about an id it did not know
+    'keydir_capacity': 4096,
+    'keydir_miss_ttl': 300,
+}
+
+PROFILES = {
+    # few tags, long idle periods: batch hard and wake the radio/CPU rarely
+    'battery-scanner': {
+        'queue_size': 50,
+        'stats_interval': 600,
+        'scan_refresh': 120,
+        'scan_max_devices': 256,
+        'report_window': 1800,
+        'upload_batch': 200,
+        'upload_interval': 600.0,
+    },
+    # mains powered, many tags: deep queues, async pipeline, prompt uploads
+    'fixed-gateway': {
+        'pipeline': 'asyncio',
+        'queue_size': 2000,
+        'consumer_batch': 128,
+        'scan_max_devices': 8192,
+        'upload_batch': 500,
+        'upload_interval': 10.0,
+        'encrypt_workers': 2,
+    },
+    # owner-set / owner-find on a phone or laptop next to the tag
+    'owner': {
+        'duplicate_data': True,
+        'scan_refresh': 5,
+        'select_window': 30,
+        'select_poll': 1.0,
+        'upload_interval': 30.0,
+    },
+}
+
+# (min, max) for numeric settings, choices for strings
+LIMITS = {
+    'queue_size': (1, 100000),
+    'consumer_batch': (1, 10000),
+    'stats_interval': (0, 86400),
+    'reset_window': (1, 86400),
+    'accessory_max_age': (60, 30 * 86400),
+    'select_window': (1, 3600),
+    'select_poll': (0.1, 600),
+    'scan_refresh': (0, 3600),
+    'scan_max_devices': (1, 1000000),
+    'scan_max_age': (1, 86400),
+    'report_window': (0, 86400),
+    'report_min_distance': (0, 1e7),
+    'upload_batch': (1, 10000),
+    'upload_interval': (0.1, 86400),
+    'upload_timeout': (0.1, 600),
+    'encrypt_workers': (0, 256),
+    'keydir_capacity': (1, 1000000),
+    'keydir_miss_ttl': (0, 86400),
+    'pipeline': ('thread', 'asyncio'),
+    'encrypt_pool': ('thread', 'process'),
+}
+
+# only read at startup; a reload that changes them logs a warning
+RESTART_ONLY = {'pipeline', 'queue_size', 'duplicate_data', 'encrypt_workers',
+                'encrypt_pool', 'provision_bulk', 'select_window',
+                'select_poll'}
+
+
+def Parse(name, raw):
+    # string (env / --set) -> the type of the setting's default
+    default = DEFAULTS[name]
+    if isinstance(default, bool):
+        if raw.lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if raw.lower() in ('0', 'false', 'no', 'off'):
+            return False
+        raise ValueError('{}: not a boolean: {}'.format(name, raw))
+    return type(default)(raw)
+
+
+def Validate(values):
+    errors = []
+    for name, value in values.items():
+        if name not in DEFAULTS:
+            errors.append('unknown setting: {}'.format(name))
+            continue
+        default = DEFAULTS[name]
+        if isinstance(default, float) and isinstance(value, int) and \
+                not isinstance(value, bool):
+            value = values[name] = float(value)
+        if type(value) is not type(default):
+            errors.append('{}: expected {}, got {!r}'.format(
+                name, type(default).__name__, value))
+            continue
+        limit = LIMITS.get(name)
+        if limit is None:
+            continue
+        if isinstance(value, str):
+            if value not in limit:
+                errors.append('{}: {!r} not one of {}'.format(name, value, limit))
+        elif not limit[0] <= value <= limit[1]:
+            errors.append('{}: {} outside [{}, {}]'.format(
+                name, value, limit[0], limit[1]))
+    # a non-string server is already reported as a type error
+    server = values.get('server')
+    if isinstance(server, str) and \
+            not server.startswith(('http://', 'https://')):
+        errors.append('server: not an http(s) URL: {}'.format(server))
+    if errors:
+        raise ValueError('invalid settings:\n  ' + '\n  '.join(errors))
+    return values
+
+
+class Settings():
+    # Scanner runtime settings, merged lowest to highest from DEFAULTS, a
+    # named profile, a JSON file, BLE_<NAME> environment variables and
+    # command line overrides. Values are plain attributes (conf.queue_size).
+    # Reload() re-reads file and environment and notifies OnReload callbacks.
+    def __init__(self, profile=None, path=None, overrides=None, environ=None):
+        self.profile = profile
+        self.path = path
+        self.overrides = dict(overrides or {})
+        self.environ = os.environ if environ is None else environ
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.values = {}
+        self.Load()
+
+    def _Merge(self):
+        values = dict(DEFAULTS)
+        from_file = {}
+        if self.path:
+            with open(self.path, 'r') as f:
+                from_file = json.load(f)
+                f.close()
+            if not isinstance(from_file, dict):
+                raise ValueError('{}: expected a JSON object'.format(self.path))
+        profile = from_file.pop('profile', None) or self.profile
+        if profile:
+            if not isinstance(profile, str) or profile not in PROFILES:
+                raise ValueError('unknown profile: {} (one of {})'.format(
+                    profile, ', '.join(sorted(PROFILES))))
+            values.update(PROFILES[profile])
+        values.update(from_file)
+        for name in DEFAULTS:
+            raw = self.environ.get(ENV_PREFIX + name.upper())
+            if raw is not None:
+                values[name] = Parse(name, raw)
+        values.update(self.overrides)
+        return Validate(values)
+
+    def Load(self):
+        # returns the names whose value changed
+        with self.lock:
+            values = self._Merge()
+            changed = {k for k, v in values.items() if self.values.get(k) != v}
+            self.values = values
+            self.__dict__.update(values)
+        return changed
+
+    def Reload(self):
+        try:
+            changed = self.Load()
+        except (OSError, ValueError) as e:
+            logger.error('settings not reloaded, keeping current: {}'.format(e))
+            return set()
+        if not changed:
+            return changed
+        logger.info('settings reloaded: {}'.format(
+            {k: self.values[k] for k in sorted(changed)}))
+        later = changed & RESTART_ONLY
+        if later:
+            logger.warning('restart to apply: {}'.format(', '.join(sorted(later))))
+        for callback in self.callbacks:
+            callback(self, changed)
+        return changed
+
+    def OnReload(self, callback):
+        self.callbacks.append(callback)
+
+    def Url(self, path):
+        return self.server.rstrip('/') + path
+
+
+def ParseOverride(text):
+    # "name=value" from --set
+    name, _, raw = text.partition('=')
+    name = name.strip().replace('-', '_')
+    if name not in DEFAULTS:
+        raise ValueError('unknown setting: {}'.format(name))
+    return name, Parse(name, raw.strip())
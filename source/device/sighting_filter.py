@@ -0,0 +1,58 @@
+import collections
+import datetime
+import math
+import threading
+
+
+def Distance(loc_a, loc_b):
+    # metres between two (lat, lon) tuples; opaque locations only
+    # compare equal or not
+    if isinstance(loc_a, tuple) and isinstance(loc_b, tuple):
+        lat_a, lon_a = map(math.radians, loc_a[:2])
+        lat_b, lon_b = map(math.radians, loc_b[:2])
+        h = math.sin((lat_b - lat_a) / 2) ** 2 + math.cos(lat_a) * \
+            math.cos(lat_b) * math.sin((lon_b - lon_a) / 2) ** 2
+        return 2 * 6371000 * math.asin(math.sqrt(h))
+    return 0 if loc_a == loc_b else math.inf
+
+
+class SightingFilter():
+    # Per public key suppression: a key is reported at most once per window
+    # unless the scanner moved more than min_distance since the last report.
+    def __init__(self, window=datetime.timedelta(minutes=10), min_distance=100):
+        self.window = window
+        self.min_distance = min_distance
+        self.sent = collections.OrderedDict()
+        # key_bytes -> (time, location), oldest first
+        self.lock = threading.Lock()
+        self.sent_num = 0
+        self.suppressed_num = 0
+
+    def ShouldSend(self, key_bytes, location, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        with self.lock:
+            self._Expire(now)
+            last = self.sent.get(key_bytes)
+            if last is not None and (now - last[0]) < self.window and \
+                    Distance(last[1], location) < self.min_distance:
+                self.suppressed_num += 1
+                return False
+            self.sent[key_bytes] = (now, location)
+            self.sent.move_to_end(key_bytes)
+            self.sent_num += 1
+            return True
+
+    def _Expire(self, now):
+        while self.sent:
+            sent_time, _ = next(iter(self.sent.values()))
+            if (now - sent_time) < self.window:
+                break
+            self.sent.popitem(last=False)
+
+    def Stats(self):
+        return {
+            'tracked': len(self.sent),
+            'sent': self.sent_num,
+            'suppressed': self.suppressed_num,
+        }
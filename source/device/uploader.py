@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger('BLELogger')
+
+REGISTER_PATH = '/ble/register'
+REGISTER_URL = "https://bletracker.supportvector.com" + REGISTER_PATH
+SpoolPath = 'spool'
+
+UPLOADED = metrics.REGISTRY.Counter(
+    'ble_uploaded_reports_total', 'Reports accepted by the server')
+UPLOAD_FAILURES = metrics.REGISTRY.Counter(
+    'ble_upload_failures_total', 'Upload requests that failed')
+UPLOAD_SECONDS = metrics.REGISTRY.Histogram(
+    'ble_upload_seconds', 'Time for one upload request')
+
+
+class UploadProc(threading.Thread):
+    # Collects reports and posts them in batches over one pooled session.
+    # A batch is flushed when it reaches batch_size or after flush_interval
+    # seconds; batches that fail are written to SpoolPath and replayed later.
+    def __init__(self, url=REGISTER_URL, batch_size=50, flush_interval=60,
+                 timeout=10, spool_path=SpoolPath):
+        self.url = url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.spool_path = spool_path
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=2))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=2))
+        self.pending = []
+        self.cond = threading.Condition()
+        self._stop = False
+        self.uploaded_num = 0
+        # batches spooled by an earlier run are replayed (and counted) too
+        self.spooled_num = self.SpooledReports()
+        metrics.REGISTRY.Gauge('ble_spooled_reports',
+                               'Reports waiting in the on-disk spool',
+                               fn=lambda: self.spooled_num)
+        super().__init__(daemon=True)
+
+    def Add(self, report):
+        # sighting time in ms, so a batch replayed from the spool hours
+        # later is not stored under the replay time
+        report.setdefault('timestamp', int(time.time() * 1000))
+        with self.cond:
+            self.pending.append(report)
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+
+    def Post(self, reports):
+        # single reports keep the legacy body so old servers still accept them
+        if len(reports) == 1:
+            body = reports[0]
+        else:
+            body = {'reports': reports}
+        start = metrics.Start()
+        try:
+            r = self.session.post(self.url, json=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.info("Upload failed. {}".format(e))
+            UPLOAD_FAILURES.Inc()
+            return False
+        finally:
+            UPLOAD_SECONDS.ObserveSince(start)
+        try:
+            ok = r.status_code == 200 and r.json().get('code', -1) == 0
+        except (ValueError, AttributeError):
+            # not a JSON object: a proxy page, an HTML error, an empty body
+            ok = False
+        if ok:
+            logger.info("Uploaded {} reports!".format(len(reports)))
+            self.uploaded_num += len(reports)
+            UPLOADED.Inc(len(reports))
+            return True
+        logger.info("Upload failed. {}".format(r.text))
+        UPLOAD_FAILURES.Inc()
+        return False
+
+    def Spool(self, reports):
+        os.makedirs(self.spool_path, exist_ok=True)
+        name = os.path.join(self.spool_path,
+                            '{:.6f}.json'.format(time.time()))
+        with open(name, 'w') as f:
+            json.dump(reports, f)
+            f.close()
+        self.spooled_num += len(reports)
+        logger.info('{} reports spooled to {}'.format(len(reports), name))
+
+    def SpoolFiles(self):
+        if not os.path.isdir(self.spool_path):
+            return []
+        return [os.path.join(self.spool_path, name)
+                for name in sorted(os.listdir(self.spool_path))
+                if name.endswith('.json')]
+
+    def SpooledReports(self):
+        num = 0
+        for path in self.SpoolFiles():
+            try:
+                with open(path, 'r') as f:
+                    num += len(json.load(f))
+                    f.close()
+            except (OSError, ValueError):
+                continue
+        return num
+
+    def Replay(self):
+        # oldest first; stop at the first failure, the server is likely down
+        for path in self.SpoolFiles():
+            try:
+                with open(path, 'r') as f:
+                    reports = json.load(f)
+                    f.close()
+            except ValueError as e:
+                logger.warning('unreadable spool file {}, set aside. {}'.format(
+                    path, e))
+                os.replace(path, path + '.bad')
+                continue
+            if not self.Post(reports):
+                return
+            os.remove(path)
+            self.spooled_num = max(0, self.spooled_num - len(reports))
+
+    def Flush(self):
+        with self.cond:
+            reports = self.pending
+            self.pending = []
+        if not reports:
+            if self.spooled_num:
+                self.Replay()
+            return
+        if self.Post(reports):
+            self.Replay()
+        else:
+            self.Spool(reports)
+
+    def run(self):
+        logger.info("Hello UploadProc!")
+        self.Replay()
+        while not self._stop:
+            with self.cond:
+                if len(self.pending) < self.batch_size:
+                    self.cond.wait(timeout=self.flush_interval)
+            self.Flush()
+
+    def stop(self):
+        logger.info('Byebye UploadProc!')
+        with self.cond:
+            self._stop = True
+            self.cond.notify()
+        self.join(timeout=self.timeout * 2)
+        self.Flush()
@@ -0,0 +1,121 @@
+import argparse
+import base64
+import http.client
+import json
+import os
+import threading
+import time
+
+import server
+import store
+
+QUERY_PAGE = 100
+
+
+def Client(host, port, requests_num, batch, results, index):
+    conn = http.client.HTTPConnection(host, port)
+    key = base64.b64encode(os.urandom(64)).decode('utf-8')
+    content = base64.b64encode(os.urandom(64)).decode('utf-8')
+    report = {'key': key, 'content': content}
+    if batch > 1:
+        body = json.dumps({'reports': [report] * batch})
+    else:
+        body = json.dumps(report)
+    headers = {'Content-Type': 'application/json'}
+    ok = 0
+    for _ in range(requests_num):
+        conn.request('POST', '/ble/register', body, headers)
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            ok += 1
+    conn.close()
+    results[index] = (key, ok)
+
+
+def QueryClient(host, port, key, queries_num, results, index):
+    # rotates through the single-key, paged and legacy GET queries; a paged
+    # query follows the cursor, each page counting as one request
+    conn = http.client.HTTPConnection(host, port)
+    headers = {'Content-Type': 'application/json'}
+    ok = 0
+    for i in range(queries_num):
+        if i % 3 == 1:
+            body = {'key': key, 'limit': QUERY_PAGE}
+            more = True
+            while more:
+                conn.request('POST', '/ble/query', json.dumps(body), headers)
+                response = conn.getresponse()
+                data = json.loads(response.read())
+                ok += response.status == 200
+                more = data.get('more', False)
+                body['cursor'] = data.get('cursor')
+            continue
+        if i % 3 == 0:
+            conn.request('POST', '/ble/query', json.dumps({'key': key}), headers)
+        else:
+            conn.request('GET', '/', key.encode('utf-8'))
+        response = conn.getresponse()
+        response.read()
+        ok += response.status == 200
+    conn.close()
+    results[index] = ok
+
+
+def RunThreads(target, args):
+    threads = [threading.Thread(target=target, args=a) for a in args]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def Run(clients, requests_num, batch, workers, db=None, queries_num=None):
+    report_store = None
+    if db:
+        report_store = store.SQLiteReportStore(db)
+    httpd = server.MakeServer('localhost', 0, workers, report_store)
+    host, port = httpd.server_address
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    if queries_num is None:
+        queries_num = requests_num
+    results = [None] * clients
+    elapsed = RunThreads(Client, [
+        (host, port, requests_num, batch, results, i) for i in range(clients)])
+    queried = [0] * clients
+    query_elapsed = RunThreads(QueryClient, [
+        (host, port, key, queries_num, queried, i)
+        for i, (key, _) in enumerate(results)])
+    httpd.shutdown()
+    httpd.server_close()
+    if report_store is not None:
+        report_store.close()
+    ok = sum(n for _, n in results)
+    return {
+        'clients': clients,
+        'requests': ok,
+        'reports': ok * batch,
+        'seconds': elapsed,
+        'requests_per_sec': ok / elapsed,
+        'reports_per_sec': ok * batch / elapsed,
+        'query_requests': sum(queried),
+        'query_seconds': query_elapsed,
+        'query_requests_per_sec': sum(queried) / query_elapsed,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--queries', type=int, default=None,
+                        help='queries per client after ingest (default: --requests)')
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--db', type=str, default=None,
+                        help='benchmark against a SQLite store at this path')
+    args = parser.parse_args()
+    print(json.dumps(Run(args.clients, args.requests, args.batch, args.workers,
+                         args.db, args.queries), indent=2))
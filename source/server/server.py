@@ -0,0 +1,266 @@
+import argparse
+import base64
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# the metrics registry is shared with the scanner in ../device
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'device'))
+import metrics
+import store
+
+logger = logging.getLogger('BLEServer')
+
+MAX_PAGE = 500
+MAX_KEYS = 1000
+# same as ble_helper.KEY_ID_LEN / KeyId on the device and accessory
+KEY_ID_LEN = 16
+
+
+def KeyId(key_bytes):
+    return hashlib.sha256(key_bytes).digest()[:KEY_ID_LEN]
+
+
+REQUESTS = metrics.REGISTRY.Counter(
+    'ble_server_requests_total', 'HTTP requests handled')
+BAD_REQUESTS = metrics.REGISTRY.Counter(
+    'ble_server_bad_requests_total', 'Requests rejected as malformed')
+INGESTED = metrics.REGISTRY.Counter(
+    'ble_server_reports_ingested_total', 'Reports stored')
+QUERIED_KEYS = metrics.REGISTRY.Counter(
+    'ble_server_queried_keys_total', 'Keys looked up by owner queries')
+REQUEST_SECONDS = metrics.REGISTRY.Histogram(
+    'ble_server_request_seconds', 'Time to handle one POST request')
+
+
+class ReportStore():
+    # latest report per public key, same semantics as test_server.accessories
+    def __init__(self):
+        self.reports = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def Add(self, key, content, timestamp=None):
+        self.AddMany([(key, content, timestamp)])
+
+    def AddMany(self, records):
+        now = int(time.time() * 1000)
+        with self.lock:
+            for key, content, timestamp in records:
+                self.reports[key] = (content, now if timestamp is None else timestamp)
+
+    def Query(self, key, since=None):
+        with self.lock:
+            report = self.reports.get(key)
+        if report is None or (since and report[1] < since):
+            return []
+        return [{'content': report[0], 'timestamp': report[1]}]
+
+    def AddKeys(self, pairs):
+        with self.lock:
+            for key_id, key in pairs:
+                self.keys.setdefault(key_id, key)
+
+    def Keys(self, key_ids):
+        with self.lock:
+            return {i: self.keys[i] for i in key_ids if i in self.keys}
+
+    def Page(self, key, since=None, cursor=None, limit=100):
+        after = store.ParseCursor(cursor)
+        results = self.Query(key, since)
+        if after is not None:
+            results = [r for r in results if r['timestamp'] > after[0]]
+        if results:
+            cursor = '{}:0'.format(results[-1]['timestamp'])
+        return results[:limit], cursor, False
+
+
+class Request(BaseHTTPRequestHandler):
+    # HTTP/1.1 so scanners can keep one connection open for many uploads
+    protocol_version = 'HTTP/1.1'
+    # drop idle keep-alive connections so they do not pin pool workers
+    timeout = 30
+    # headers and body go out in separate writes; don't let Nagle hold the body
+    disable_nagle_algorithm = True
+    store = None
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _Read(self):
+        length = int(self.headers.get('content-length', 0))
+        return self.rfile.read(length)
+
+    def _Send(self, body, code=200, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _SendJSON(self, obj, code=200):
+        self._Send(json.dumps(obj).encode('utf-8'), code)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._Send(metrics.REGISTRY.Render().encode('utf-8'),
+                       content_type='text/plain; version=0.0.4')
+            return
+        REQUESTS.Inc()
+        # legacy query: body is base64(key), reply base64(content) or 0xFF
+        key = base64.b64decode(self._Read())
+        results = self.store.Query(key)
+        if results:
+            body = results[-1]['content'].encode('utf-8')
+        else:
+            body = base64.b64encode(bytes([0xFF]))
+        self._Send(body, content_type='text/plain')
+
+    def do_POST(self):
+        REQUESTS.Inc()
+        start = metrics.Start()
+        request_raw = self._Read()
+        try:
+            if self.path == '/ble/register':
+                self._Register(json.loads(request_raw))
+            elif self.path == '/ble/query':
+                self._Query(json.loads(request_raw))
+            elif self.path == '/ble/keys':
+                self._Keys(json.loads(request_raw))
+            else:
+                # legacy register: body is base64(json)
+                data = json.loads(base64.b64decode(request_raw).decode('utf-8'))
+                self._Register(data)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.info('bad request: {}'.format(e))
+            BAD_REQUESTS.Inc()
+            self._SendJSON({'code': -1, 'msg': 'bad request'}, 400)
+        REQUEST_SECONDS.ObserveSince(start)
+
+    def _Register(self, data):
+        # one report {'key', 'content'} or a batch {'reports': [...]}
+        reports = data['reports'] if 'reports' in data else [data]
+        records = [(base64.b64decode(r['key']), r['content'],
+                    r.get('timestamp')) for r in reports]
+        self.store.AddMany(records)
+        INGESTED.Inc(len(records))
+        self._SendJSON({'code': 0, 'count': len(records)})
+
+    def _Keys(self, data):
+        # key directory for compact beacons: {'key'} registers a public key
+        # under its id, {'ids': [hex]} answers {'keys': {hex: base64 key}}
+        if 'key' in data:
+            key = base64.b64decode(data['key'])
+            key_id = KeyId(key)
+            self.store.AddKeys([(key_id, key)])
+            self._SendJSON({'code': 0, 'id': key_id.hex()})
+            return
+        ids = data['ids']
+        if len(ids) > MAX_KEYS:
+            self._SendJSON({'code': -1, 'msg': 'too many keys'}, 400)
+            return
+        found = self.store.Keys(bytes.fromhex(i) for i in ids)
+        self._SendJSON({'code': 0, 'keys': {
+            i.hex(): base64.b64encode(k).decode('utf-8')
+            for i, k in found.items()}})
+
+    def _Query(self, data):
+        # without 'limit' answer in one response as before; with it, page
+        # by cursor: resend the returned 'cursor' while 'more' is true
+        if 'keys' in data:
+            self._QueryMany(data)
+            return
+        key = base64.b64decode(data['key'])
+        QUERIED_KEYS.Inc()
+        if 'limit' not in data and 'cursor' not in data:
+            results = self.store.Query(key, since=data.get('since'))
+            self._SendJSON({'code': 0, 'results': results})
+            return
+        limit = min(int(data.get('limit') or MAX_PAGE), MAX_PAGE)
+        results, cursor, more = self.store.Page(
+            key, data.get('since'), data.get('cursor'), limit)
+        self._SendJSON({'code': 0, 'results': results, 'cursor': cursor,
+                        'more': more})
+
+    def _QueryMany(self, data):
+        # fleet lookup: {'keys': [{'key', 'since', 'cursor'}], 'limit'} is
+        # answered with one indexed page per key, keyed by the base64 key
+        entries = data['keys']
+        if len(entries) > MAX_KEYS:
+            self._SendJSON({'code': -1, 'msg': 'too many keys'}, 400)
+            return
+        limit = min(int(data.get('limit') or MAX_PAGE), MAX_PAGE)
+        QUERIED_KEYS.Inc(len(entries))
+        answer = {}
+        for entry in entries:
+            results, cursor, more = self.store.Page(
+                base64.b64decode(entry['key']), entry.get('since'),
+                entry.get('cursor'), limit)
+            answer[entry['key']] = {'results': results, 'cursor': cursor,
+                                    'more': more}
+        self._SendJSON({'code': 0, 'results': answer})
+
+
+class PooledHTTPServer(HTTPServer):
+    # serves each connection on a bounded worker pool instead of one thread
+    # per request (ThreadingHTTPServer) or one at a time (HTTPServer)
+    def __init__(self, server_address, handler, workers=32):
+        super().__init__(server_address, handler)
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix='Request')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._Process, request, client_address)
+
+    def _Process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def MakeServer(host, port, workers=32, store=None):
+    handler = type('BoundRequest', (Request,), {'store': store or ReportStore()})
+    return PooledHTTPServer((host, port), handler, workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--db', type=str, default='reports.db',
+                        help="SQLite file for reports ('' keeps the latest "
+                             "report per key in memory only)")
+    parser.add_argument('--retention-days', type=float, default=30)
+    parser.add_argument('--metrics', action='store_true',
+                        help='collect metrics, served at GET /metrics')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.metrics:
+        metrics.Enable()
+    report_store = None
+    if args.db:
+        report_store = store.SQLiteReportStore(args.db, args.retention_days)
+        report_store.start()
+    server = MakeServer(args.host, args.port, args.workers, report_store)
+    logger.info('listen at: {}'.format(server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        if report_store is not None:
+            report_store.close()
@@ -0,0 +1,138 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('BLEServer')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    key BLOB NOT NULL,
+    timestamp INTEGER NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reports_key_time ON reports (key, timestamp);
+CREATE INDEX IF NOT EXISTS reports_time ON reports (timestamp);
+CREATE TABLE IF NOT EXISTS key_directory (
+    id BLOB PRIMARY KEY,
+    key BLOB NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+def ParseCursor(cursor):
+    if not cursor:
+        return None
+    timestamp, row_id = cursor.split(':')
+    return int(timestamp), int(row_id)
+
+
+class SQLiteReportStore():
+    # Durable store keeping every report, indexed by (key, timestamp) so
+    # "reports for key K since T" is a range scan. Same interface as
+    # server.ReportStore. Timestamps are milliseconds since the epoch.
+    def __init__(self, path, retention_days=30, prune_interval=3600):
+        self.path = path
+        self.retention_ms = int(retention_days * 24 * 3600 * 1000)
+        self.prune_interval = prune_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self.pruner = None
+
+    def Add(self, key, content, timestamp=None):
+        self.AddMany([(key, content, timestamp)])
+
+    def AddMany(self, records):
+        # one transaction for the whole batch
+        now = int(time.time() * 1000)
+        rows = [(key, now if timestamp is None else timestamp, content)
+                for key, content, timestamp in records]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO reports (key, timestamp, content) VALUES (?, ?, ?)',
+                rows)
+
+    def Query(self, key, since=None):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT content, timestamp FROM reports '
+                'WHERE key = ? AND timestamp >= ? ORDER BY timestamp',
+                (key, since or 0)).fetchall()
+        return [{'content': c, 'timestamp': t} for c, t in rows]
+
+    def Page(self, key, since=None, cursor=None, limit=100):
+        # keyset pagination on (timestamp, id); cursor is "timestamp:id" of
+        # the last report returned and stays valid across new inserts
+        after = ParseCursor(cursor) or (since or 0, -1)
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, content, timestamp FROM reports '
+                'WHERE key = ? AND (timestamp, id) > (?, ?) '
+                'ORDER BY timestamp, id LIMIT ?',
+                (key, after[0], after[1], limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            cursor = '{}:{}'.format(rows[-1][2], rows[-1][0])
+        results = [{'content': c, 'timestamp': t} for _, c, t in rows]
+        return results, cursor, more
+
+    def AddKeys(self, pairs):
+        # (key_id, key); the first key registered under an id wins
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO key_directory (id, key) VALUES (?, ?)',
+                pairs)
+
+    def Keys(self, key_ids):
+        key_ids = list(key_ids)
+        if not key_ids:
+            return {}
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, key FROM key_directory WHERE id IN ({})'.format(
+                    ','.join('?' * len(key_ids))), key_ids).fetchall()
+        return {bytes(i): bytes(k) for i, k in rows}
+
+    def Prune(self, now=None, chunk=10000):
+        # delete in chunks so ingest is not locked out for long
+        if not self.retention_ms:
+            return 0
+        if now is None:
+            now = int(time.time() * 1000)
+        cutoff = now - self.retention_ms
+        pruned = 0
+        while True:
+            with self.lock, self.conn:
+                cur = self.conn.execute(
+                    'DELETE FROM reports WHERE id IN (SELECT id FROM reports '
+                    'WHERE timestamp < ? LIMIT ?)', (cutoff, chunk))
+            pruned += cur.rowcount
+            if cur.rowcount < chunk:
+                break
+        if pruned:
+            logger.info('pruned {} reports older than {}'.format(pruned, cutoff))
+        return pruned
+
+    def _PruneLoop(self):
+        while not self._stop.wait(self.prune_interval):
+            try:
+                self.Prune()
+            except sqlite3.Error as e:
+                logger.error('prune failed: {}'.format(e))
+
+    def start(self):
+        self.Prune()
+        self.pruner = threading.Thread(target=self._PruneLoop, daemon=True,
+                                       name='Pruner')
+        self.pruner.start()
+
+    def close(self):
+        self._stop.set()
+        with self.lock:
+            self.conn.close()